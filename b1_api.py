@@ -1,110 +1,299 @@
-import requests
-from config import B1_API_KEY, DATA_FOLDER
-import os
+import atexit
 import datetime
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+from config import (
+    B1_API_KEY, B1_API_URL, B1_TIMEOUT, B1_MAX_CONCURRENCY, B1_MAX_RETRIES,
+    DATA_FOLDER, SUPPLIER_MISS_TTL_DAYS, MAPPING_COMPACT_DAYS, ShopConfig, default_shop
+)
+from supplier_cache import SupplierCache
+
+# Barcodes per items/list request and items per returned page
+BARCODE_BATCH_SIZE = 100
+ITEMS_PAGE_SIZE = 100
+
+
+class B1Client:
+    """
+    Client for the B1 API that all calls go through. It keeps one pooled keep-alive
+    session, applies connect/read timeouts, limits how many requests run at once and
+    retries 5xx answers and connection errors with jittered exponential backoff.
+    """
+
+    def __init__(self, api_key: str, base_url: str = B1_API_URL, timeout: float = B1_TIMEOUT,
+                 max_concurrency: int = B1_MAX_CONCURRENCY, max_retries: int = B1_MAX_RETRIES,
+                 backoff: float = 0.5):
+        self.base_url = base_url.rstrip("/") + "/"
+        self.timeout = (5, timeout)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            'B1-Api-Key': api_key,
+            'Content-Type': 'application/json',
+        })
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._stats_lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"calls": 0, "errors": 0, "retries": 0, "seconds": 0.0, "max_seconds": 0.0})
+
+    def _record(self, path: str, seconds: float, error: bool, retry: bool) -> None:
+        with self._stats_lock:
+            stats = self._stats[path]
+            stats["calls"] += 1
+            stats["errors"] += error
+            stats["retries"] += retry
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        metrics.record_stage("b1.request", seconds, error)
+        metrics.count("b1.requests")
+        metrics.count("b1.retries", int(retry))
+
+    def stats(self) -> dict:
+        """Per-endpoint call counts, errors, retries and latency (seconds)."""
+        with self._stats_lock:
+            return {path: dict(stats) for path, stats in self._stats.items()}
+
+    def post(self, path: str, body: dict, retry: bool = True):
+        """POSTs to an API path, returns (json, status code)."""
+        attempts = self.max_retries + 1 if retry else 1
+        for attempt in range(1, attempts + 1):
+            last_attempt = attempt == attempts
+            started = time.perf_counter()
+            try:
+                with self._semaphore:
+                    response = self.session.post(self.base_url + path, json=body, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record(path, time.perf_counter() - started, error=True, retry=not last_attempt)
+                if last_attempt:
+                    raise
+            else:
+                transient = response.status_code >= 500
+                self._record(path, time.perf_counter() - started, error=transient, retry=transient and not last_attempt)
+                if not transient or last_attempt:
+                    return response.json(), response.status_code
+            time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+
+def open_supplier_cache(cache_folder: str) -> SupplierCache:
+    cache = SupplierCache(
+        os.path.join(cache_folder, "supplier_cache.sqlite"),
+        mapping_csv=os.path.join(cache_folder, "mapping.csv"),
+        miss_ttl_days=SUPPLIER_MISS_TTL_DAYS,
+        compact_every_days=MAPPING_COMPACT_DAYS,
+    )
+    atexit.register(cache.flush)
+    return cache
+
+
+B1_CLIENT = B1Client(B1_API_KEY)
+SUPPLIER_CACHE = open_supplier_cache(DATA_FOLDER)
 
-SUPPLIER_CACHE = {}
+# Other shops' clients by API key and supplier caches by cache folder, created when first used
+_clients = {B1_API_KEY: B1_CLIENT}
+_supplier_caches = {DATA_FOLDER: SUPPLIER_CACHE}
+_registry_lock = threading.Lock()
+_compaction_disabled = False
 
-def fetch_b1_data(url: str, body: dict) -> dict:
+def get_b1_client(shop: ShopConfig = None) -> B1Client:
+    """The client for the shop's B1 API key (B1_CLIENT for the default shop)."""
+    api_key = (shop or default_shop()).b1_api_key
+    with _registry_lock:
+        if api_key not in _clients:
+            _clients[api_key] = B1Client(api_key)
+        return _clients[api_key]
+
+def get_supplier_cache(shop: ShopConfig = None) -> SupplierCache:
+    """The supplier cache in the shop's cache folder (SUPPLIER_CACHE for the default shop)."""
+    cache_folder = (shop or default_shop()).cache_folder
+    with _registry_lock:
+        if cache_folder not in _supplier_caches:
+            cache = open_supplier_cache(cache_folder)
+            if _compaction_disabled:
+                cache.compact_every = float("inf")
+            _supplier_caches[cache_folder] = cache
+        return _supplier_caches[cache_folder]
+
+def init_worker() -> None:
+    """
+    Initializer of the process pools that build reports (backfill_script, multi_shop, report_jobs):
+    mapping.csv is compacted once by the parent, so workers never rewrite it under each other,
+    and runs inherited from the parent are dropped so the workers' own runs are saved.
+    """
+    disable_mapping_compaction()
+    metrics.reset()
+
+def disable_mapping_compaction() -> None:
+    """
+    Keeps the supplier caches of this process from compacting mapping.csv, for worker processes
+    whose parent compacts it once at the end, so workers never rewrite it under each other.
+    """
+    global _compaction_disabled
+    with _registry_lock:
+        _compaction_disabled = True
+        for cache in _supplier_caches.values():
+            cache.compact_every = float("inf")
+
+
+def fetch_b1_data(url: str, body: dict, retry: bool = True, client: B1Client = None) -> dict:
     """Fetches data from the B1 API."""
-    url = f"https://www.b1.lt/api/{url}"
-    headers = {
-        'B1-Api-Key': B1_API_KEY,
-        'Content-Type': 'application/json',
-    }
-    response = requests.post(url, headers=headers, json=body)
-    return response.json(), response.status_code
+    return (client or B1_CLIENT).post(url, body, retry=retry)
 
 
-def get_supplier_by_barcode(barcode: str) -> str:
-    """Get the supplier name by barcode."""
-    if barcode.isdigit():
+def fetch_suppliers_for_batch(barcodes: list, client: B1Client = None) -> dict:
+    """
+    Looks up a batch of barcodes with one OR-filter, paging through items/list until
+    all matching items are read. Barcodes without an item map to None.
+    Returns None if the API did not answer properly, so nothing gets cached.
+    """
+    found = {}
+    page = 1
+    while True:
         body = {
-            "rows": 100,
-            "page": 1,
+            "rows": ITEMS_PAGE_SIZE,
+            "page": page,
             "filters": {
-                "groupOp": "AND",
+                "groupOp": "OR",
                 "rules": [
                     {
                         "field": "barcode",
                         "op": "eq",
                         "data": barcode
                     }
+                    for barcode in barcodes
                 ]
             }
         }
-        if barcode in SUPPLIER_CACHE:
-            return SUPPLIER_CACHE[barcode]
+        response, status = fetch_b1_data("reference-book/items/list", body, client=client)
+        if status != 200:
+            return None
+        items = response.get('data') or []
+        for item in items:
+            # the first item per barcode wins, as with the single lookup
+            found.setdefault(str(item.get('barcode')), item.get('manufacturerName'))
+        if len(items) < ITEMS_PAGE_SIZE:
+            break
+        page += 1
+    return {barcode: found.get(barcode) for barcode in barcodes}
+
+
+@metrics.timed("b1.supplier_lookup")
+def get_suppliers_by_barcodes(barcodes: Iterable[str], shop: ShopConfig = None) -> dict:
+    """Get the supplier names for many barcodes, asking B1 only for those not cached."""
+    client = get_b1_client(shop)
+    supplier_cache = get_supplier_cache(shop)
+    results = {}
+    unresolved = []
+    cache_hits = 0
+    for barcode in dict.fromkeys(barcodes):
+        if not barcode.isdigit():
+            results[barcode] = None
+            continue
+        found, supplier = supplier_cache.lookup(barcode)
+        if found:
+            cache_hits += 1
+            results[barcode] = supplier
+        else:
+            unresolved.append(barcode)
 
+    def lookup(batch):
         try:
-            response, status = fetch_b1_data("reference-book/items/list", body)
-            if status != 200 or not response.get('data'):
-                return None
-            # temp: add a line to the csv file
-            with open(os.path.join(DATA_FOLDER, "mapping.csv"), "a") as f:
-                f.seek(0, os.SEEK_END) # check if there ia a newline at the end of the file
-                if f.tell() > 0:
-                    f.seek(-1, os.SEEK_END)
-                    if f.read(1) != "\n":
-                        f.write("\n")
-                f.write(f"{barcode},{response['data'][0]['manufacturerName']}\n")
-            SUPPLIER_CACHE[barcode] = response['data'][0]['manufacturerName']
-            return response['data'][0]['manufacturerName']
-        except:
-            return None
-    return None
+            return batch, fetch_suppliers_for_batch(batch, client)
+        except (requests.RequestException, ValueError):
+            return batch, None
+
+    metrics.count("b1.cache_hits", cache_hits)
+    metrics.count("b1.cache_misses", len(unresolved))
+    batches = [unresolved[i:i + BARCODE_BATCH_SIZE] for i in range(0, len(unresolved), BARCODE_BATCH_SIZE)]
+    resolved = {}
+    with ThreadPoolExecutor(max_workers=client.max_concurrency) as executor:
+        for batch, batch_result in executor.map(lookup, batches):
+            if batch_result is None:
+                metrics.count("b1.failed_batches")
+                results.update(dict.fromkeys(batch))
+            else:
+                resolved.update(batch_result)
+
+    # an empty result is remembered as a miss, so it is not asked again until it expires
+    supplier_cache.store_many(resolved)
+    results.update(resolved)
+    return results
 
-def create_cash_receipt(sum, full_date, number, try_count=1):
-    """Create a cash receipt in the B1 system."""
-    if try_count > 2:
-        print("Error: Maximum number of retries reached.")
-        return 0
+
+def get_supplier_by_barcode(barcode: str, shop: ShopConfig = None) -> str:
+    """Get the supplier name by barcode."""
+    return get_suppliers_by_barcodes([barcode], shop).get(barcode)
+
+@metrics.timed("b1.cash_receipt")
+def create_cash_receipt(sum, full_date, number, max_tries=2, shop: ShopConfig = None):
+    """
+    Create a cash receipt in the B1 system. If the document number is already taken
+    (HTTP 400), the next number is tried. Returns how many numbers were used, 0 on failure.
+    """
     date = full_date.split(" ")[0]
-    number = str(number).zfill(5)
-    body = {
-        "clientAccountId": 195,
-        "clientId": 2,
-        "currencyId": 2,
-        "currencyCode": "EUR",
-        "date": date,
-        "debitAccountId": 510,
-        "series": "PPK",
-        "number": number,
-        "total": sum,
-        "attachment": "Inkasuota suma " + date.replace("-", " "),
-        "documentStatusId": 5,
-        "employeeId": 39
-    }
     path = "cash-flow/cash-receipts/create"
-    response, status = fetch_b1_data(path, body)
-    if status == 400:
-        return create_cash_receipt(sum, full_date, number + 1, try_count + 1)
-    elif status == 200:
-        return try_count
-    else:
-        print(f"Unexpected error: {response}")
-        return 0
+    for try_count in range(1, max_tries + 1):
+        body = {
+            "clientAccountId": 195,
+            "clientId": 2,
+            "currencyId": 2,
+            "currencyCode": "EUR",
+            "date": date,
+            "debitAccountId": 510,
+            "series": "PPK",
+            "number": str(number + try_count - 1).zfill(5),
+            "total": sum,
+            "attachment": "Inkasuota suma " + date.replace("-", " "),
+            "documentStatusId": 5,
+            "employeeId": 39
+        }
+        # not retried by the client: a repeated create could book the receipt twice
+        response, status = fetch_b1_data(path, body, retry=False, client=get_b1_client(shop))
+        if status == 200:
+            return try_count
+        elif status != 400:
+            print(f"Unexpected error: {response}")
+            return 0
+    print("Error: Maximum number of retries reached.")
+    return 0
+
 
+def document_number_path(shop: ShopConfig = None) -> str:
+    return os.path.join((shop or default_shop()).data_folder, "cash_receipt_num.txt")
 
-def read_document_number():
+def read_document_number(shop: ShopConfig = None):
     """Read the current document number from the file."""
     try:
-        with open(os.path.join(DATA_FOLDER, "cash_receipt_num.txt"), 'r') as f:
+        with open(document_number_path(shop), 'r') as f:
             return int(f.read().strip())
     except FileNotFoundError:
         # return the today's date without spaces and symbols
         return int("".join(str(datetime.datetime.now().date()).split("-")))
 
-def save_document_number(number):
+def save_document_number(number, shop: ShopConfig = None):
     """Save the document number to the file."""
-    with open(os.path.join(DATA_FOLDER, "cash_receipt_num.txt"), 'w') as f:
+    with open(document_number_path(shop), 'w') as f:
         f.write(str(number))
 
-def process_new_cash_receipt(sum, full_date):
+def process_new_cash_receipt(sum, full_date, shop: ShopConfig = None):
     """Process a new cash receipt, track the document number"""
-    doc_number = read_document_number()
-    tries = create_cash_receipt(sum, full_date, doc_number)
+    doc_number = read_document_number(shop)
+    tries = create_cash_receipt(sum, full_date, doc_number, shop=shop)
     if tries and doc_number < 20250000:
-        save_document_number(doc_number + tries)
+        save_document_number(doc_number + tries, shop)
         return True
     return False
@@ -0,0 +1,147 @@
+import argparse
+import multiprocessing
+import os
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import date
+
+import metrics
+from config import default_shop, load_shops
+from pos_client import POSClient
+from b1_api import init_worker
+from supplier_cache import compact_mapping_csv
+from weekly_script import get_week_interval, get_week_paths, download_week_export, reduced_sales_report
+
+
+def weeks_in_year(year):
+    """Number of ISO weeks in a year (52 or 53)."""
+    return date(year, 12, 28).isocalendar()[1]
+
+
+def iter_weeks(start, end):
+    """All (year, week) pairs from start to end, both included."""
+    year, week = start
+    while (year, week) <= end:
+        yield year, week
+        week += 1
+        if week > weeks_in_year(year):
+            year, week = year + 1, 1
+
+
+def parse_week(value):
+    """Parses YEAR-WEEK, e.g. 2024-7."""
+    year, week = value.split("-")
+    return int(year), int(week)
+
+
+def find_shop(key):
+    """The shop with that key among load_shops()."""
+    for shop in load_shops():
+        if shop.key == key:
+            return shop
+    raise ValueError(f"Unknown shop: {key}")
+
+
+def is_up_to_date(year, week_number, shop):
+    """Whether the week's reports exist and are newer than its export and mapping.csv."""
+    paths = get_week_paths(year, week_number, shop)
+    if not all(os.path.exists(paths[key]) for key in ('export', 'excel', 'html')):
+        return False
+    sources = [paths['export']] + ([shop.mapping_csv] if os.path.exists(shop.mapping_csv) else [])
+    newest_source = max(os.path.getmtime(path) for path in sources)
+    return all(os.path.getmtime(paths[key]) >= newest_source for key in ('excel', 'html'))
+
+
+def process_week(year, week_number, shop=None):
+    """Builds one week's reports from its downloaded export (runs in a worker process)."""
+    started = time.perf_counter()
+    reduced_sales_report(year, week_number, reprocess=True, shop=shop)
+    return time.perf_counter() - started
+
+
+def backfill(start, end, sessions=2, processes=None, force=False, shop=None):
+    """
+    Regenerates the reports of every week from start to end ((year, week) pairs), for the shop
+    (the default shop if not given).
+    Missing exports are downloaded over a small pool of logged in POS sessions, and each week
+    is handed to a process pool for parsing, mapping, Excel and HTML as soon as its export is there.
+    Weeks whose reports are newer than their export and mapping.csv are skipped unless force is set.
+    Weeks that have not ended yet are left to weekly_script, which would skip them once an export exists.
+    """
+    shop = shop or default_shop()
+    started = time.perf_counter()
+    weeks = [
+        (year, week) for year, week in iter_weeks(start, end)
+        if get_week_interval(year, week)[1] < date.today() and (force or not is_up_to_date(year, week, shop))
+    ]
+    skipped = sum(1 for _ in iter_weeks(start, end)) - len(weeks)
+    to_download = [(year, week) for year, week in weeks if not os.path.exists(get_week_paths(year, week, shop)['export'])]
+    print(f"Backfill: {len(weeks)} weeks to build ({len(to_download)} to download), {skipped} skipped.")
+
+    sessions_pool = queue.Queue()
+    clients = []
+    for slot in range(min(sessions, len(to_download))):
+        client = POSClient(grid='Transactions', session_slot=slot, shop=shop)
+        client.ensure_login()
+        clients.append(client)
+        sessions_pool.put(client)
+
+    def download(year, week_number):
+        start_date, end_date = get_week_interval(year, week_number)
+        client = sessions_pool.get()
+        try:
+            download_week_export(client, start_date, end_date, get_week_paths(year, week_number, shop)['export'])
+        finally:
+            sessions_pool.put(client)
+
+    built, failed = [], []
+    # spawn: the workers start while the download threads are mid-request, and a forked child
+    # could inherit a lock one of them holds
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=init_worker) as process_pool, \
+            ThreadPoolExecutor(max_workers=max(1, len(clients))) as download_pool:
+        downloads = {download_pool.submit(download, *week): week for week in to_download}
+        builds = {process_pool.submit(process_week, *week, shop): week for week in weeks if week not in to_download}
+        for future in as_completed(downloads):
+            week = downloads[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Download of week {week[1]} of {week[0]} failed: {e}")
+                failed.append(week)
+                continue
+            builds[process_pool.submit(process_week, *week, shop)] = week
+        for future in as_completed(builds):
+            week = builds[future]
+            try:
+                future.result()
+                built.append(week)
+            except Exception as e:
+                print(f"Building week {week[1]} of {week[0]} failed: {e}")
+                failed.append(week)
+
+    for client in clients:
+        client.logout()
+    if os.path.exists(shop.mapping_csv):
+        compact_mapping_csv(shop.mapping_csv)
+
+    elapsed = time.perf_counter() - started
+    rate = len(built) / elapsed * 60 if elapsed else 0
+    print(f"Backfill done in {elapsed:.1f}s: {len(built)} weeks built, {skipped} skipped, "
+          f"{len(failed)} failed ({rate:.1f} weeks/min).")
+    return built, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regenerate weekly reports for a range of weeks.")
+    parser.add_argument("start", type=parse_week, help="first week, YEAR-WEEK (e.g. 2024-1)")
+    parser.add_argument("end", type=parse_week, help="last week, YEAR-WEEK (e.g. 2024-52)")
+    parser.add_argument("--sessions", type=int, default=2, help="POS sessions used for downloads")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--force", action="store_true", help="rebuild weeks that are up to date")
+    parser.add_argument("--shop", default=None, help="key of the shop (see SHOPS), default: the single shop")
+    args = parser.parse_args()
+    shop = find_shop(args.shop) if args.shop else None
+    with metrics.run("backfill", shop=(shop or default_shop()).key):
+        backfill(args.start, args.end, sessions=args.sessions, processes=args.processes, force=args.force, shop=shop)
@@ -0,0 +1,184 @@
+"""
+Synthetic POS exports for the benchmarks, shaped like the real ones: Windows-1257, ';' separated,
+',' decimals, NBSP thousand separators and the Lithuanian column names of the Transactions and
+ZReports grids. The same parameters and seed always give the same files.
+
+    python -m benchmarks.generate transactions out.csv --rows 1000000 --products 20000 --suppliers 300
+    python -m benchmarks.generate zreports z.csv --rows 365
+"""
+import argparse
+import csv
+import json
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+# Columns of the full Transactions grid; the report reads a subset (data_processing.TRANSACTION_COLUMNS)
+TRANSACTIONS_HEADER = [
+    'Kasos nr.', 'Ar aktyvus?', 'Ar čekis atmestas?', 'Nuol. suma 1', 'Nuol. suma 2',
+    'Darb. vardas', 'Čekio nr.', 'Prekės kodas', 'Prekės pavadinimas', 'Kiekis', 'Pagr. kaina',
+    'Pagr. suma', 'Suma', 'Mok. suma', 'PVM %', 'Mokėjimo būdas', 'Įrašo data',
+]
+ZREPORTS_HEADER = [
+    'Įmonė', 'Parduotuvė', 'Adresas', 'Kasa', 'Kasos nr.', 'Pamaina', 'Data', 'Darb. vardas',
+    'GT', 'Fiskalo nr.', 'Grynais', 'Kortele', 'Išimta gryn. 1', 'Išimta gryn. 2', 'Čekių sk.',
+    'Anuliuota', 'Suma',
+]
+EMPLOYEES = ['Jūratė', 'Ona', 'Reda', 'Rūta', 'Žydrūnas', 'Aušra', 'Vaidas', 'Eglė']
+PAYMENT_METHODS = ['Grynais', 'Kortele', 'Kortele', 'Kortele']
+PRODUCT_WORDS = [
+    'Pienas', 'Sūris', 'Duona', 'Kefyras', 'Obuoliai', 'Bulvės', 'Šokoladas', 'Kava', 'Arbata',
+    'Sultys', 'Dešra', 'Žuvis', 'Grietinė', 'Varškė', 'Ledai', 'Alus', 'Vanduo', 'Muilas',
+]
+PRODUCT_ADJECTIVES = ['ekologiškas', 'šviežias', 'rūkytas', 'trapus', 'lietuviškas', 'saldus', 'didelis']
+SUPPLIER_WORDS = ['Žalgiris', 'Rūta', 'Pieno žvaigždės', 'Švyturys', 'Vilkyškių', 'Biovela', 'Gubernija']
+
+
+def format_money(value: float) -> str:
+    """1234.5 -> '1 234,50' with a non-breaking space, as the POS exports it."""
+    return f"{value:,.2f}".replace(',', '\xa0').replace('.', ',')
+
+def format_quantity(value: float) -> str:
+    return str(int(value)) if value == int(value) else f"{value:.3f}".replace('.', ',')
+
+
+def supplier_names(count: int) -> list:
+    """Distinct supplier names in the forms B1 uses (UAB „...“, AB ...)."""
+    names = []
+    for i in range(count):
+        word = SUPPLIER_WORDS[i % len(SUPPLIER_WORDS)]
+        form = 'UAB' if i % 3 else 'AB'
+        names.append(f'{form} „{word} {i + 1}“' if i % 2 else f'{form} "{word} {i + 1}"')
+    return names
+
+
+class Catalogue:
+    """
+    Products with their barcodes, names, prices and suppliers. Each supplier has a GS1-like
+    company prefix (477 + 4 digits) that its barcodes start with; products are sold with a
+    Zipf-like popularity, so a few products make up most rows as in a real shop.
+    """
+
+    def __init__(self, products: int, suppliers: int, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.suppliers = supplier_names(suppliers)
+        self.prefixes = [f"477{1000 + i:04d}" for i in range(suppliers)]
+        self.product_supplier = rng.integers(0, suppliers, products)
+        # 13 digits like an EAN-13, unique for up to a million products
+        self.codes = [f"{self.prefixes[s]}{i % 100_000:05d}{i // 100_000}" for i, s in enumerate(self.product_supplier)]
+        self.names = [
+            f"{PRODUCT_WORDS[i % len(PRODUCT_WORDS)]} {PRODUCT_ADJECTIVES[i % len(PRODUCT_ADJECTIVES)]} {i}"
+            for i in range(products)
+        ]
+        self.prices = np.round(rng.lognormal(1.2, 1.0, products), 2) + 0.09
+        self.weighted = rng.random(products) < 0.1
+        popularity = 1 / np.arange(1, products + 1) ** 0.9
+        self.popularity = rng.permutation(popularity / popularity.sum())
+
+    def write_mapping(self, path: str, coverage: float = 0.7, seed: int = 2) -> None:
+        """mapping.csv (UTF-8) for a share of the products."""
+        rng = np.random.default_rng(seed)
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['Prekės kodas', 'Tiekėjas'])
+            for code, supplier in zip(self.codes, self.product_supplier):
+                if rng.random() < coverage:
+                    writer.writerow([code, self.suppliers[supplier]])
+
+    def prefix_map(self, coverage: float = 0.3, seed: int = 3) -> dict:
+        """A PREFIX_SUPPLIER_MAP for a share of the suppliers."""
+        rng = np.random.default_rng(seed)
+        return {prefix: name for prefix, name in zip(self.prefixes, self.suppliers) if rng.random() < coverage}
+
+    def write_prefix_map(self, path: str, coverage: float = 0.3, seed: int = 3) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.prefix_map(coverage, seed), f, ensure_ascii=False)
+
+
+def generate_transactions(path: str, rows: int, catalogue: Catalogue, week_start: date,
+                          discount_share: float = 0.15, inactive_share: float = 0.02,
+                          rejected_share: float = 0.01, seed: int = 4, chunk_rows: int = 100_000) -> None:
+    """Writes a Transactions export of `rows` lines over the week starting at week_start."""
+    rng = np.random.default_rng(seed)
+    week_start = datetime.combine(week_start, datetime.min.time())
+    receipt = 100_000
+    with open(path, 'w', encoding='Windows-1257', newline='') as f:
+        f.write(';'.join(TRANSACTIONS_HEADER) + '\r\n')
+        for start in range(0, rows, chunk_rows):
+            n = min(chunk_rows, rows - start)
+            products = rng.choice(len(catalogue.codes), n, p=catalogue.popularity)
+            quantities = np.where(catalogue.weighted[products], np.round(rng.uniform(0.1, 2.5, n), 3),
+                                  rng.integers(1, 4, n))
+            prices = catalogue.prices[products]
+            base = prices * quantities
+            discounted = rng.random(n) < discount_share
+            discounts = np.where(discounted, np.round(base * rng.choice([0.1, 0.2, 0.3, 0.5], n), 2), 0.0)
+            active = (rng.random(n) >= inactive_share).astype(int)
+            rejected = (rng.random(n) < rejected_share).astype(int)
+            # about five lines per receipt, receipts in time order over the week
+            receipts = receipt + np.cumsum(rng.random(n) < 0.2)
+            receipt = int(receipts[-1]) + 1
+            seconds = np.sort(rng.integers(start * 7 * 86400 // rows, (start + n) * 7 * 86400 // rows, n))
+            employees = rng.integers(0, len(EMPLOYEES), n)
+            payments = rng.integers(0, len(PAYMENT_METHODS), n)
+
+            lines = []
+            for i in range(n):
+                product = products[i]
+                total = base[i] - discounts[i]
+                lines.append(';'.join((
+                    str(1 + employees[i] % 3), str(active[i]), str(rejected[i]),
+                    format_money(discounts[i]), '0', EMPLOYEES[employees[i]], str(receipts[i]),
+                    catalogue.codes[product], catalogue.names[product], format_quantity(quantities[i]),
+                    format_money(prices[i]), format_money(base[i]), format_money(total), format_money(total),
+                    '21', PAYMENT_METHODS[payments[i]],
+                    (week_start + timedelta(seconds=int(seconds[i]))).strftime('%Y-%m-%d %H:%M:%S'),
+                )))
+            f.write('\r\n'.join(lines) + '\r\n')
+
+
+def generate_zreports(path: str, rows: int, first_day: date = date(2024, 1, 1), registers: int = 1,
+                      seed: int = 5) -> None:
+    """Writes a ZReports export with one line per register and day, `rows` lines in all."""
+    rng = np.random.default_rng(seed)
+    with open(path, 'w', encoding='Windows-1257', newline='') as f:
+        f.write(';'.join(ZREPORTS_HEADER) + '\r\n')
+        total = 0.0
+        for i in range(rows):
+            day = first_day + timedelta(days=i // registers)
+            cash, card = np.round(rng.lognormal(6.5, 0.6, 2), 2)
+            taken_1 = np.round(cash * rng.uniform(0.5, 0.9), 2)
+            taken_2 = np.round(cash * rng.uniform(0, 0.1), 2) if rng.random() < 0.3 else 0.0
+            total += cash + card
+            f.write(';'.join((
+                'UAB „Parduotuvė“', 'Demo', 'Gedimino pr. 1, Vilnius', f'K{i % registers + 1}',
+                str(i % registers + 1), str(i + 1), f"{day:%Y-%m-%d} {rng.integers(18, 22)}:00:01",
+                EMPLOYEES[int(rng.integers(0, len(EMPLOYEES)))], format_money(total), f"LT{10_000_000 + i % registers}",
+                format_money(cash), format_money(card), format_money(taken_1),
+                format_money(taken_2) if taken_2 else '', str(int(rng.integers(50, 400))), '0',
+                format_money(cash + card),
+            )) + '\r\n')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic POS exports for the benchmarks.")
+    parser.add_argument("kind", choices=["transactions", "zreports"])
+    parser.add_argument("path")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--products", type=int, default=5_000, help="distinct products (transactions)")
+    parser.add_argument("--suppliers", type=int, default=200, help="distinct suppliers (transactions)")
+    parser.add_argument("--discount-share", type=float, default=0.15, help="share of discounted lines")
+    parser.add_argument("--week-start", type=date.fromisoformat, default=date(2024, 1, 1))
+    parser.add_argument("--mapping", help="also write a mapping.csv for the products here")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.kind == "zreports":
+        generate_zreports(args.path, args.rows, first_day=args.week_start, seed=args.seed)
+    else:
+        catalogue = Catalogue(args.products, args.suppliers, seed=args.seed)
+        generate_transactions(args.path, args.rows, catalogue, args.week_start,
+                              discount_share=args.discount_share, seed=args.seed)
+        if args.mapping:
+            catalogue.write_mapping(args.mapping)
+    print(f"Wrote {args.rows} rows to {args.path}")
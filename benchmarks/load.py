@@ -0,0 +1,214 @@
+"""
+Offline load test of the fetch path: starts the POS, B1 and SMTP stand-ins (see standins.py),
+points config's URLs at them and runs daily_script.main or weekly_script.reduced_sales_report
+for many shops and weeks in parallel worker processes. Reports the time of each stage and the
+counters, added up from the runs the scripts record (see metrics.py), and the HTTP calls each
+stand-in answered, and writes them as JSON.
+
+    python -m benchmarks.load weekly --shops 4 --weeks 3 --parallel 4 --export-delay 2
+    python -m benchmarks.load daily --shops 10 --pos-latency 0.1 --b1-error-rate 0.05
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from itertools import islice
+
+from benchmarks.generate import Catalogue
+
+
+class EveningDatetime(datetime):
+    """datetime whose now() is 18:00 today, so the daily script runs whatever time it is."""
+
+    @classmethod
+    def now(cls, tz=None):
+        return datetime.now(tz).replace(hour=18)
+
+
+def init_worker() -> None:
+    import b1_api
+    import daily_script
+
+    b1_api.init_worker()
+    daily_script.datetime = EveningDatetime
+
+
+def run_task(job: str, shop, year: int = None, week_number: int = None) -> dict:
+    """Runs one daily or weekly job (in a worker process). Returns its duration and error."""
+    started = time.perf_counter()
+    error = None
+    try:
+        if job == "daily":
+            from daily_script import main
+            main(shop)
+        else:
+            from weekly_script import reduced_sales_report
+            reduced_sales_report(year, week_number, shop=shop)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return {"seconds": time.perf_counter() - started, "error": error}
+
+
+def make_shops(count: int, workdir: str) -> list:
+    """count shops sharing the cache folder (mapping.csv and the supplier cache) in workdir."""
+    from dataclasses import replace
+    from config import default_shop
+    shops = []
+    for i in range(1, count + 1):
+        data_folder = os.path.join(workdir, "shops", f"shop{i}")
+        os.makedirs(data_folder, exist_ok=True)
+        shops.append(replace(default_shop(), key=f"shop{i}", name=f"Shop {i}", data_folder=data_folder,
+                             username=f"user{i}", reporting_email=f"shop{i}@standin.local",
+                             daily_email=f"shop{i}@standin.local"))
+    return shops
+
+
+def merge_runs(runs: list):
+    """Adds up the stages and counters of the recorded runs. Returns the stages and the counters."""
+    stages, counters = {}, {}
+    for record in runs:
+        for name, stats in record["stages"].items():
+            total = stages.setdefault(name, {"calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0})
+            total["calls"] += stats["calls"]
+            total["errors"] += stats["errors"]
+            total["seconds"] += stats["seconds"]
+            total["max_seconds"] = max(total["max_seconds"], stats["max_seconds"])
+        for name, value in record["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+    return dict(sorted(stages.items())), dict(sorted(counters.items()))
+
+
+def print_report(report: dict) -> None:
+    print(f"\n{report['tasks']} {report['job']} tasks in {report['wall_seconds']:.1f}s "
+          f"({report['failed']} failed, {report['parallel']} at a time)")
+    print(f"\n{'stage':<46}{'calls':>7}{'errors':>7}{'total s':>10}{'mean s':>9}{'max s':>9}")
+    for stage, stats in report["stages"].items():
+        mean = stats["seconds"] / stats["calls"] if stats["calls"] else 0
+        print(f"{stage:<46}{stats['calls']:>7}{stats['errors']:>7}{stats['seconds']:>10.2f}"
+              f"{mean:>9.3f}{stats['max_seconds']:>9.3f}")
+    print()
+    for name, value in report["counters"].items():
+        print(f"{name:<46}{value:>14}")
+    for server, endpoints in report["http_calls"].items():
+        print(f"\n{server}:")
+        for endpoint, stats in endpoints.items():
+            print(f"  {endpoint:<44}{stats['calls']:>7} calls {stats['errors']:>5} errors "
+                  f"{stats['bytes'] / 2 ** 20:>9.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the daily or weekly job against local stand-in servers.")
+    parser.add_argument("job", choices=["daily", "weekly"])
+    parser.add_argument("--shops", type=int, default=2, help="shops to run the job for")
+    parser.add_argument("--weeks", type=int, default=1, help="weeks per shop (weekly), from --first-week on")
+    parser.add_argument("--first-week", default="2024-1", help="YEAR-WEEK of the first week (weekly)")
+    parser.add_argument("--parallel", type=int, default=4, help="worker processes")
+    parser.add_argument("--rows", type=int, default=50_000, help="rows of the Transactions export")
+    parser.add_argument("--products", type=int, default=5_000)
+    parser.add_argument("--suppliers", type=int, default=200)
+    parser.add_argument("--mapping-coverage", type=float, default=0.7, help="share of products in mapping.csv")
+    parser.add_argument("--pos-latency", type=float, default=0.0, help="seconds added to each POS request")
+    parser.add_argument("--pos-error-rate", type=float, default=0.0, help="share of POS requests answered 500")
+    parser.add_argument("--export-delay", type=float, default=0.0, help="seconds the POS takes to build an export")
+    parser.add_argument("--bandwidth", type=int, default=0, help="POS download bytes per second (0: unlimited)")
+    parser.add_argument("--b1-latency", type=float, default=0.0, help="seconds added to each B1 request")
+    parser.add_argument("--b1-error-rate", type=float, default=0.0, help="share of B1 requests answered 500")
+    parser.add_argument("--b1-coverage", type=float, default=0.5, help="share of barcodes B1 knows")
+    parser.add_argument("--workdir", default=os.path.join("benchmarks", "data", "load"))
+    parser.add_argument("--output", help="JSON report file (default: load_<time>.json next to the workdir)")
+    args = parser.parse_args()
+
+    from benchmarks.standins import POSServer, B1Server, SMTPServer
+
+    # every run starts from empty shop folders, caches and run records, so nothing is skipped as
+    # already done and only this run's records are added up
+    os.makedirs(args.workdir, exist_ok=True)
+    for folder in ("shops", "outbox"):
+        shutil.rmtree(os.path.join(args.workdir, folder), ignore_errors=True)
+    for name in ("supplier_cache.sqlite", "runs.jsonl", "runs.jsonl.1"):
+        if os.path.exists(os.path.join(args.workdir, name)):
+            os.remove(os.path.join(args.workdir, name))
+    catalogue = Catalogue(args.products, args.suppliers)
+    catalogue.write_mapping(os.path.join(args.workdir, "mapping.csv"), coverage=args.mapping_coverage)
+    pos = POSServer(catalogue, args.workdir, transactions_rows=args.rows, latency=args.pos_latency,
+                    error_rate=args.pos_error_rate, export_delay=args.export_delay, bandwidth=args.bandwidth).start()
+    b1 = B1Server(catalogue, coverage=args.b1_coverage, latency=args.b1_latency, error_rate=args.b1_error_rate).start()
+    smtp = SMTPServer().start()
+
+    # set before config is imported here and inherited by the (spawned) workers
+    os.environ.update(pos.environment())
+    os.environ.update(b1.environment())
+    os.environ.update(smtp.environment())
+    os.environ.update({
+        "FOLDER": os.path.abspath(args.workdir),
+        "OUTBOX_FOLDER": os.path.abspath(os.path.join(args.workdir, "outbox")),
+        "PREFIX_SUPPLIER_MAP": json.dumps(catalogue.prefix_map()),
+        "POS_SESSION_FILE": "",
+        "USERNAME": "user", "PASSWORD": "secret",
+    })
+
+    shops = make_shops(args.shops, os.path.abspath(args.workdir))
+    if args.job == "daily":
+        tasks = [("daily", shop) for shop in shops]
+    else:
+        from backfill_script import iter_weeks, parse_week
+        first = parse_week(args.first_week)
+        weeks = list(islice(iter_weeks(first, (first[0] + 100, 1)), args.weeks))
+        tasks = [("weekly", shop, year, week) for shop in shops for year, week in weeks]
+
+    print(f"Running {len(tasks)} {args.job} tasks, {args.parallel} at a time...")
+    started = time.perf_counter()
+    results, failed = [], 0
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.parallel, mp_context=context, initializer=init_worker) as pool:
+        futures = [pool.submit(run_task, *task) for task in tasks]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result["error"]:
+                failed += 1
+                print(f"Task failed: {result['error']}")
+
+    # mail left in the outbox by the workers' background senders
+    import email_service
+    import metrics
+    with metrics.run("email"):
+        email_service.deliver_outbox(force=True)
+    wall_seconds = time.perf_counter() - started
+
+    # the workers' runs (and their background senders'), as the scripts recorded them
+    runs = metrics.load_recent_runs(limit=sys.maxsize)
+    stages, counters = merge_runs(runs)
+    stages["task"] = {
+        "calls": len(results),
+        "errors": failed,
+        "seconds": sum(result["seconds"] for result in results),
+        "max_seconds": max((result["seconds"] for result in results), default=0.0),
+    }
+    report = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "job": args.job,
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "workdir")},
+        "tasks": len(tasks),
+        "parallel": args.parallel,
+        "failed": failed,
+        "wall_seconds": wall_seconds,
+        "runs": {job: sum(1 for record in runs if record["job"] == job) for job in sorted({record["job"] for record in runs})},
+        "stages": stages,
+        "counters": counters,
+        "http_calls": {"pos": pos.stats.snapshot(), "b1": b1.stats.snapshot(), "smtp": smtp.stats.snapshot()},
+        "outbox_left": len(email_service.due_messages(force=True)),
+    }
+    print_report(report)
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(args.workdir)),
+                                         f"load_{report['started_at'].replace(':', '')}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport written to {output}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,230 @@
+"""
+Times and memory-profiles the weekly report pipeline on synthetic exports (see generate.py)
+and writes the results as JSON, so runs can be compared:
+
+    python -m benchmarks.run --rows 100000 --rows 1000000 --output results.json
+    python -m benchmarks.run --rows 100000 --compare results.json
+
+Each stage runs --repeat times on the output of the previous one; the best time counts.
+Peak memory is measured in one extra run of each stage under tracemalloc (Python and NumPy
+allocations), which is slower, so --no-memory skips it. B1 is replaced by a stub that knows
+the supplier of a share of the barcodes, so no request leaves the machine.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+from benchmarks.generate import Catalogue, generate_transactions, generate_zreports
+
+WEEK_START = date(2024, 1, 1)
+# Stage times more than this many times the baseline's count as regressions (see --compare),
+# unless they are within MIN_REGRESSION_SECONDS of it (timer noise on the fast stages)
+REGRESSION_THRESHOLD = 1.25
+MIN_REGRESSION_SECONDS = 0.01
+
+
+def dataset_paths(workdir: str, rows: int, products: int, suppliers: int, seed: int) -> dict:
+    name = f"{rows}r_{products}p_{suppliers}s_{seed}"
+    return {
+        'transactions': os.path.join(workdir, f"transactions_{name}.csv"),
+        'zreports': os.path.join(workdir, f"zreports_{seed}.csv"),
+        'mapping': os.path.join(workdir, f"mapping_{products}p_{suppliers}s_{seed}.csv"),
+    }
+
+def prepare_dataset(workdir: str, rows: int, products: int, suppliers: int, seed: int,
+                    discount_share: float) -> dict:
+    """Generates the exports of a run, reusing the files of an earlier run with the same parameters."""
+    os.makedirs(workdir, exist_ok=True)
+    paths = dataset_paths(workdir, rows, products, suppliers, seed)
+    catalogue = Catalogue(products, suppliers, seed=seed)
+    if not os.path.exists(paths['transactions']):
+        print(f"Generating {rows} transactions...")
+        generate_transactions(paths['transactions'] + '.tmp', rows, catalogue, WEEK_START,
+                              discount_share=discount_share, seed=seed)
+        os.replace(paths['transactions'] + '.tmp', paths['transactions'])
+    if not os.path.exists(paths['mapping']):
+        catalogue.write_mapping(paths['mapping'], seed=seed)
+    if not os.path.exists(paths['zreports']):
+        generate_zreports(paths['zreports'], 365, first_day=WEEK_START, seed=seed)
+    paths['catalogue'] = catalogue
+    return paths
+
+
+class StubB1:
+    """Stands in for b1_api.get_suppliers_by_barcodes: knows the supplier of a share of the barcodes."""
+
+    def __init__(self, catalogue: Catalogue, coverage: float = 0.5):
+        self.suppliers = {
+            code: catalogue.suppliers[supplier]
+            for i, (code, supplier) in enumerate(zip(catalogue.codes, catalogue.product_supplier))
+            if i % 100 < coverage * 100
+        }
+        self.calls = 0
+        self.barcodes = 0
+
+    def __call__(self, barcodes, shop=None) -> dict:
+        barcodes = list(barcodes)
+        self.calls += 1
+        self.barcodes += len(barcodes)
+        return {barcode: self.suppliers.get(barcode) for barcode in barcodes}
+
+
+def measure(function, repeat: int, memory: bool) -> dict:
+    """Runs function repeat times (and once more under tracemalloc). Returns the timings and the last result."""
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - started)
+    stats = {'seconds': seconds, 'best': min(seconds), 'mean': sum(seconds) / len(seconds)}
+    if memory:
+        result = None
+        tracemalloc.start()
+        try:
+            result = function()
+            stats['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    return stats, result
+
+
+def run_pipeline(paths: dict, workdir: str, repeat: int, memory: bool) -> dict:
+    """Runs each stage of the weekly report on the dataset and returns their measurements."""
+    import data_processing
+    from dataclasses import replace
+    from config import default_shop
+    from data_processing import (
+        TRANSACTION_COLUMNS, TRANSACTIONS_SCHEMA, TRANSACTIONS_DATE_COLUMNS, SALES_COLUMNS,
+        read_csv_windows1257, filter_discounted_sales, map_suppliers,
+        summarize_discounts_by_supplier, save_excel
+    )
+    from reporting import generate_html_report
+    from weekly_script import build_report_tables
+    from zreport import read_zreport
+
+    catalogue = paths['catalogue']
+    stub = StubB1(catalogue)
+    data_processing.get_suppliers_by_barcodes = stub
+    shop = replace(default_shop(), prefix_supplier_map=catalogue.prefix_map())
+    excel_path = os.path.join(workdir, "bench.xlsx")
+    stages = {}
+
+    def stage(name, function, rows_in=None):
+        print(f"  {name}...", flush=True)
+        stats, result = measure(function, repeat, memory)
+        stats['rows_in'] = rows_in
+        stats['rows_out'] = len(result) if hasattr(result, '__len__') else None
+        stages[name] = stats
+        return result
+
+    df = stage('read_csv_windows1257', lambda: read_csv_windows1257(
+        paths['transactions'], usecols=TRANSACTION_COLUMNS, dtype=TRANSACTIONS_SCHEMA,
+        parse_dates=TRANSACTIONS_DATE_COLUMNS))
+    discounted = stage('filter_discounted_sales', lambda: filter_discounted_sales(df), len(df))
+
+    sales = discounted.rename(columns={'Nuol. suma 1': 'Nuolaida'})
+    sales['Prekės kodas'] = sales['Prekės kodas'].astype(int)
+    stub.calls = stub.barcodes = 0
+    sales = stage('map_suppliers', lambda: map_suppliers(sales, paths['mapping'], shop=shop)[SALES_COLUMNS], len(sales))
+    runs = repeat + memory
+    stages['map_suppliers']['b1_calls'] = stub.calls // runs
+    stages['map_suppliers']['b1_barcodes'] = stub.barcodes // runs
+
+    grouped_df = stage('summarize_discounts_by_supplier', lambda: summarize_discounts_by_supplier(sales), len(sales))
+    stage('save_excel', lambda: save_excel(sales, grouped_df, excel_path), len(sales))
+    products_df, missing_values = stage('build_report_tables', lambda: build_report_tables(sales), len(sales))
+    stage('generate_html_report', lambda: generate_html_report(
+        products_df, grouped_df, missing_values, paths['transactions'],
+        WEEK_START, WEEK_START + timedelta(days=6), 1, WEEK_START.year), len(products_df))
+    stage('read_zreport', lambda: read_zreport(paths['zreports'])[1])
+    return stages
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Prints each stage's time and memory against the baseline. Returns the regressions."""
+    regressions = []
+    baseline_runs = {run['rows']: run for run in baseline['runs']}
+    for run in results['runs']:
+        base_run = baseline_runs.get(run['rows'])
+        if base_run is None:
+            continue
+        print(f"\n{run['rows']} rows, compared to {baseline['started_at']}:")
+        for name, stats in run['stages'].items():
+            base = base_run['stages'].get(name)
+            if base is None:
+                continue
+            ratio = stats['best'] / base['best'] if base['best'] else 1
+            line = f"  {name:<32} {base['best']:8.3f}s -> {stats['best']:8.3f}s  x{ratio:.2f}"
+            if 'peak_mb' in stats and 'peak_mb' in base:
+                line += f"   {base['peak_mb']:8.1f} -> {stats['peak_mb']:8.1f} MB"
+            if ratio > threshold and stats['best'] - base['best'] > MIN_REGRESSION_SECONDS:
+                line += "  REGRESSION"
+                regressions.append((run['rows'], name, ratio))
+            print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the weekly report pipeline on synthetic data.")
+    parser.add_argument("--rows", type=int, action="append", help="Transactions rows (repeatable, default 100000)")
+    parser.add_argument("--products", type=int, default=5_000, help="distinct products")
+    parser.add_argument("--suppliers", type=int, default=200, help="distinct suppliers")
+    parser.add_argument("--discount-share", type=float, default=0.15, help="share of discounted lines")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("--workdir", default=os.path.join("benchmarks", "data"),
+                        help="where the generated exports and outputs go")
+    parser.add_argument("--output", help="JSON results file (default: <workdir>/results_<time>.json)")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="slowdown factor reported as a regression (exit status 1)")
+    args = parser.parse_args()
+
+    # caches and state files of the pipeline go to the workdir, not the real DATA_FOLDER
+    os.makedirs(args.workdir, exist_ok=True)
+    os.environ["FOLDER"] = os.path.abspath(args.workdir)
+
+    import numpy as np
+    import pandas as pd
+    started_at = datetime.now().isoformat(timespec='seconds')
+    results = {
+        'started_at': started_at,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'parameters': {
+            'products': args.products, 'suppliers': args.suppliers, 'discount_share': args.discount_share,
+            'seed': args.seed, 'repeat': args.repeat, 'memory': not args.no_memory,
+        },
+        'runs': [],
+    }
+    for rows in args.rows or [100_000]:
+        paths = prepare_dataset(args.workdir, rows, args.products, args.suppliers, args.seed, args.discount_share)
+        print(f"Benchmarking {rows} rows:")
+        stages = run_pipeline(paths, args.workdir, args.repeat, not args.no_memory)
+        results['runs'].append({'rows': rows, 'file_mb': os.path.getsize(paths['transactions']) / 2 ** 20,
+                                'stages': stages})
+        for name, stats in stages.items():
+            memory = f"  peak {stats['peak_mb']:8.1f} MB" if 'peak_mb' in stats else ""
+            print(f"  {name:<32} best {stats['best']:8.3f}s  mean {stats['mean']:8.3f}s{memory}")
+    # ru_maxrss is in kilobytes on Linux
+    results['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    output = args.output or os.path.join(args.workdir, f"results_{started_at.replace(':', '')}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            sys.exit(1)
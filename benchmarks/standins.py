@@ -0,0 +1,317 @@
+"""
+Local stand-ins for the systems the scripts talk to, for load tests without touching the real ones:
+the POS endpoints POSClient uses, the two B1 API endpoints and an SMTP server that accepts and
+drops mail. Each runs in a thread of the calling process, with configurable latency, error rate
+and payload size, and counts the calls it answers.
+"""
+import gzip
+import json
+import random
+import socketserver
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.generate import Catalogue, generate_transactions, generate_zreports
+
+TOKEN = "standin-token"
+
+
+class CallStats:
+    """Calls, injected errors and bytes sent per endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = defaultdict(lambda: {"calls": 0, "errors": 0, "bytes": 0})
+
+    def record(self, endpoint: str, error: bool = False, size: int = 0) -> None:
+        with self.lock:
+            stats = self.endpoints[endpoint]
+            stats["calls"] += 1
+            stats["errors"] += error
+            stats["bytes"] += size
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {endpoint: dict(stats) for endpoint, stats in sorted(self.endpoints.items())}
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Common parts of the HTTP stand-ins: latency, injected 500s and replies."""
+    protocol_version = "HTTP/1.1"
+    error_body = b"Injected error"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def reply(self, endpoint: str, status: int, body: bytes = b"", headers=(), error: bool = False) -> None:
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.stats.record(endpoint, error=error, size=len(body))
+
+    def fail_randomly(self, endpoint: str) -> bool:
+        """Waits the configured latency, then answers 500 at the configured error rate."""
+        time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            self.reply(endpoint, 500, self.error_body, error=True)
+            return True
+        return False
+
+
+class POSHandler(StandinHandler):
+    """
+    The POS endpoints: /login/<grid> (GET form with __RequestVerificationToken, POST credentials),
+    /filter/<grid>, /export, /download (gzip and Range supported) and /logout.
+    Sessions are kept by a cookie; the export is only downloadable after a filter and an export.
+    """
+
+    def session(self):
+        for part in self.headers.get("Cookie", "").split(";"):
+            name, _, value = part.strip().partition("=")
+            if name == "sid" and value in self.server.sessions:
+                return self.server.sessions[value]
+        return None
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.startswith("/login"):
+            if self.fail_randomly("login"):
+                return
+            if self.session() is not None:
+                return self.reply("login", 302, headers=[("Location", "/home")])
+            page = (f'<form method="post"><input name="__RequestVerificationToken" type="hidden" value="{TOKEN}">'
+                    '<input name="UserName"><input name="Password" type="password"></form>')
+            return self.reply("login", 200, page.encode())
+        if path.startswith("/logout"):
+            for part in self.headers.get("Cookie", "").split(";"):
+                name, _, value = part.strip().partition("=")
+                if name == "sid":
+                    self.server.sessions.pop(value, None)
+            return self.reply("logout", 302, headers=[("Location", "/login")])
+        self.reply("other", 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        form = parse_qs(self.read_body().decode())
+        endpoint = url.path.strip("/").split("/")[0]
+        if self.fail_randomly(endpoint):
+            return
+        if endpoint == "login":
+            if form.get("__RequestVerificationToken") != [TOKEN] or not form.get("UserName"):
+                return self.reply("login", 200, b"Invalid login")
+            sid = uuid.uuid4().hex
+            self.server.sessions[sid] = {"user": form["UserName"][0], "grid": None, "exported": False}
+            return self.reply("login", 200, b"OK", [("Set-Cookie", f"sid={sid}; Path=/")])
+
+        session = self.session()
+        if session is None:
+            return self.reply(endpoint, 302, headers=[("Location", "/login")])
+        if endpoint == "filter":
+            session["grid"] = url.path.strip("/").split("/")[-1]
+            session["exported"] = False
+            return self.reply("filter", 200, b"OK")
+        if endpoint == "export":
+            time.sleep(self.server.export_delay)
+            session["exported"] = session["grid"] is not None
+            return self.reply("export", 200, b"OK")
+        if endpoint == "download":
+            if not session["exported"]:
+                page = b'<div class="dxpc-content">Nothing was exported</div>'
+                return self.reply("download", 500, page)
+            return self.send_export(self.server.payloads.get(session["grid"], b""))
+        self.reply(endpoint, 404)
+
+    def send_export(self, payload: bytes) -> None:
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes="):
+            start = int(range_header[6:].split("-")[0] or 0)
+            headers = [("Content-Range", f"bytes {start}-{len(payload) - 1}/{len(payload)}")]
+            return self.send_throttled(206, payload[start:], headers)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            return self.send_throttled(200, self.server.gzipped(payload), [("Content-Encoding", "gzip")])
+        self.send_throttled(200, payload)
+
+    def send_throttled(self, status: int, body: bytes, headers=()) -> None:
+        """Sends the body at most at the configured bandwidth (bytes per second, 0 = unlimited)."""
+        if not self.server.bandwidth:
+            return self.reply("download", status, body, headers)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        piece = max(1, int(self.server.bandwidth / 10))
+        for start in range(0, len(body), piece):
+            self.wfile.write(body[start:start + piece])
+            time.sleep(0.1)
+        self.server.stats.record("download", size=len(body))
+
+
+class B1Handler(StandinHandler):
+    """
+    The B1 API endpoints the scripts use: reference-book/items/list (barcode OR-filters, paged)
+    and cash-flow/cash-receipts/create (a number can only be used once).
+    """
+    error_body = b'{"message": "Injected error"}'
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = json.loads(self.read_body() or b"{}")
+        if path.endswith("reference-book/items/list"):
+            endpoint = "items/list"
+            if self.fail_randomly(endpoint):
+                return
+            barcodes = [rule["data"] for rule in body.get("filters", {}).get("rules", [])]
+            items = [
+                {"barcode": barcode, "manufacturerName": self.server.suppliers[barcode]}
+                for barcode in barcodes if barcode in self.server.suppliers
+            ]
+            rows, page = body.get("rows", 100), body.get("page", 1)
+            data = items[(page - 1) * rows:page * rows]
+            return self.reply(endpoint, 200, json.dumps({"data": data}).encode())
+        if path.endswith("cash-flow/cash-receipts/create"):
+            endpoint = "cash-receipts/create"
+            if self.fail_randomly(endpoint):
+                return
+            with self.server.lock:
+                taken = body.get("number") in self.server.receipt_numbers
+                self.server.receipt_numbers.add(body.get("number"))
+            if taken:
+                return self.reply(endpoint, 400, json.dumps({"message": "Number taken"}).encode())
+            return self.reply(endpoint, 200, json.dumps({"data": {"id": len(self.server.receipt_numbers)}}).encode())
+        self.reply("other", 404, b"{}")
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency: float = 0.0, error_rate: float = 0.0):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stats = CallStats()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self) -> "StandinServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class POSServer(StandinServer):
+    """
+    POS stand-in serving a generated Transactions export of transactions_rows rows and a
+    one-line ZReports export, whatever dates are asked for. export_delay is how long the
+    server takes to build an export; bandwidth limits downloads (bytes per second).
+    """
+
+    def __init__(self, catalogue: Catalogue, workdir: str, transactions_rows: int = 50_000,
+                 latency: float = 0.0, error_rate: float = 0.0, export_delay: float = 0.0,
+                 bandwidth: int = 0):
+        super().__init__(POSHandler, latency, error_rate)
+        self.export_delay = export_delay
+        self.bandwidth = bandwidth
+        self.sessions = {}
+        transactions_path = f"{workdir}/pos_transactions_{transactions_rows}.csv"
+        zreports_path = f"{workdir}/pos_zreports.csv"
+        generate_transactions(transactions_path, transactions_rows, catalogue, date(2024, 1, 1))
+        generate_zreports(zreports_path, 1, first_day=date.today())
+        self.payloads = {}
+        for grid, path in (("Transactions", transactions_path), ("ZReports", zreports_path)):
+            with open(path, "rb") as f:
+                self.payloads[grid] = f.read()
+        self._gzipped = {}
+
+    def gzipped(self, payload: bytes) -> bytes:
+        with self.lock:
+            if id(payload) not in self._gzipped:
+                self._gzipped[id(payload)] = gzip.compress(payload, compresslevel=6)
+            return self._gzipped[id(payload)]
+
+    def environment(self) -> dict:
+        """The config variables that point POSClient here."""
+        return {
+            "LOGIN_URL": self.url + "/login/{GRID}",
+            "FILTER_URL": self.url + "/filter/{GRID}",
+            "EXPORT_URL": self.url + "/export",
+            "DOWNLOAD_URL": self.url + "/download",
+            "LOGOUT_URL": self.url + "/logout",
+        }
+
+
+class B1Server(StandinServer):
+    """B1 stand-in that knows the supplier of a share (coverage) of the catalogue's barcodes."""
+
+    def __init__(self, catalogue: Catalogue, coverage: float = 0.5, latency: float = 0.0, error_rate: float = 0.0):
+        super().__init__(B1Handler, latency, error_rate)
+        self.suppliers = {
+            code: catalogue.suppliers[supplier]
+            for i, (code, supplier) in enumerate(zip(catalogue.codes, catalogue.product_supplier))
+            if i % 100 < coverage * 100
+        }
+        self.receipt_numbers = set()
+
+    def environment(self) -> dict:
+        return {"B1_API_URL": self.url + "/api/"}
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: accepts every message and counts it."""
+
+    def send(self, line: str) -> None:
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.send("220 standin ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.send("250 standin")
+            elif command == "DATA":
+                self.send("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    size += len(data_line)
+                self.server.stats.record("messages", size=size)
+                self.send("250 OK")
+            elif command == "QUIT":
+                self.send("221 Bye")
+                return
+            else:
+                self.send("250 OK")
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.stats = CallStats()
+
+    def start(self) -> "SMTPServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def environment(self) -> dict:
+        return {"SMTP_SERVER": "127.0.0.1", "SMTP_PORT": str(self.server_address[1]), "SMTP_STARTTLS": "0",
+                "SMTP_USER": "", "FROM_EMAIL": "reports@standin.local"}
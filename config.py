@@ -1,6 +1,7 @@
 import os
+import sys
+from dataclasses import dataclass, field, replace
 from dotenv import load_dotenv
-import json
 
 load_dotenv()  # Load environment variables from .env
 
@@ -10,6 +11,13 @@ HOST = os.getenv("HOST", "localhost")
 PORT = os.getenv("PORT", 4000)
 SSL_KEYFILE = os.getenv("SSL_KEYFILE")
 SSL_CERTFILE = os.getenv("SSL_CERTFILE")
+# How long the web server trusts what it knows about a file (size, mtime) before checking again, seconds
+FILE_STAT_TTL = float(os.getenv("FILE_STAT_TTL", 2))
+# Reports generated on request by the web server: at most this many at a time, and this many waiting
+REPORT_JOB_WORKERS = int(os.getenv("REPORT_JOB_WORKERS", 2))
+REPORT_JOB_MAX_PENDING = int(os.getenv("REPORT_JOB_MAX_PENDING", 20))
+# A failed report job is shown as failed for this long before a request starts it again, seconds
+REPORT_JOB_RETRY_SECONDS = int(os.getenv("REPORT_JOB_RETRY_SECONDS", 900))
 
 # POS-related environment variables
 LOGIN_URL = os.getenv("LOGIN_URL")
@@ -17,10 +25,15 @@ FILTER_URL = os.getenv("FILTER_URL")
 EXPORT_URL = os.getenv("EXPORT_URL")
 DOWNLOAD_URL = os.getenv("DOWNLOAD_URL")
 LOGOUT_URL = os.getenv("LOGOUT_URL")
+# Form field of the export request that selects grid columns, if the POS grid supports it
+EXPORT_COLUMNS_FIELD = os.getenv("EXPORT_COLUMNS_FIELD")
 
 # Authentication
 USERNAME = os.getenv("USERNAME")
 PASSWORD = os.getenv("PASSWORD")
+# Optional file to keep the logged in POS session between runs
+POS_SESSION_FILE = os.getenv("POS_SESSION_FILE")
+POS_SESSION_MAX_AGE_HOURS = float(os.getenv("POS_SESSION_MAX_AGE_HOURS", 8))
 
 # Email settings
 FROM_EMAIL = os.getenv("FROM_EMAIL")
@@ -30,8 +43,140 @@ REPORTING_EMAIL = os.getenv("REPORTING_EMAIL")
 DAILY_EMAIL = os.getenv("DAILY_EMAIL")
 SMTP_SERVER = os.getenv("SMTP_SERVER")
 SMTP_PORT = os.getenv("SMTP_PORT", 587)
+# Set to 0 for a server without STARTTLS, e.g. a local debugging server
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") != "0"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", 30))
+# Outgoing mail is spooled here and delivered in the background (see email_service.py)
+OUTBOX_FOLDER = os.getenv("OUTBOX_FOLDER", os.path.join(DATA_FOLDER, "outbox"))
+# Delivery is retried after SMTP_RETRY_SECONDS, doubling each time, up to SMTP_MAX_ATTEMPTS attempts
+SMTP_RETRY_SECONDS = float(os.getenv("SMTP_RETRY_SECONDS", 60))
+SMTP_MAX_ATTEMPTS = int(os.getenv("SMTP_MAX_ATTEMPTS", 10))
+
+# Each run's stage timings and counters are appended here as a JSON line (see metrics.py);
+# /metrics aggregates the last METRICS_RECENT_RUNS, and the file is rotated past METRICS_MAX_BYTES
+METRICS_FILE = os.getenv("METRICS_FILE", os.path.join(DATA_FOLDER, "runs.jsonl"))
+METRICS_RECENT_RUNS = int(os.getenv("METRICS_RECENT_RUNS", 200))
+METRICS_MAX_BYTES = int(os.getenv("METRICS_MAX_BYTES", 5 * 1024 * 1024))
+
+# Sales formats written next to the weekly Excel file, comma separated: csv.gz, parquet
+SALES_EXTRA_FORMATS = [f.strip() for f in os.getenv("SALES_EXTRA_FORMATS", "").split(",") if f.strip()]
 
 # Additional
 SHOP_NAME = os.getenv("SHOP_NAME", "Demo")
 B1_API_KEY = os.getenv("B1_API_KEY", "demo")
-PREFIX_SUPPLIER_MAP = json.loads(os.getenv("PREFIX_SUPPLIER_MAP"))
\ No newline at end of file
+B1_API_URL = os.getenv("B1_API_URL", "https://www.b1.lt/api/")
+B1_TIMEOUT = float(os.getenv("B1_TIMEOUT", 30))  # read timeout, seconds
+B1_MAX_CONCURRENCY = int(os.getenv("B1_MAX_CONCURRENCY", 4))
+B1_MAX_RETRIES = int(os.getenv("B1_MAX_RETRIES", 3))
+# Barcodes B1 could not resolve are asked again after this many days
+SUPPLIER_MISS_TTL_DAYS = float(os.getenv("SUPPLIER_MISS_TTL_DAYS", 30))
+# How often mapping.csv is rewritten without duplicates
+MAPPING_COMPACT_DAYS = float(os.getenv("MAPPING_COMPACT_DAYS", 7))
+
+
+# Several shops: a JSON list of shops, or the path of a JSON file with one (see load_shops)
+SHOPS = os.getenv("SHOPS")
+
+
+def __getattr__(name):
+    # PREFIX_SUPPLIER_MAP is only parsed by the modules that use it, not on every import of config
+    if name == "PREFIX_SUPPLIER_MAP":
+        import json
+        global PREFIX_SUPPLIER_MAP
+        PREFIX_SUPPLIER_MAP = json.loads(os.getenv("PREFIX_SUPPLIER_MAP", "{}"))
+        return PREFIX_SUPPLIER_MAP
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@dataclass(frozen=True)
+class ShopConfig:
+    """
+    Everything that differs between shops. It is passed explicitly (as `shop`) to POSClient,
+    b1_api and the scripts; where it is left out, the default shop is used.
+    """
+    key: str
+    name: str
+    # where the shop's exports, reports and state files go
+    data_folder: str
+    # where mapping.csv and the supplier cache are; shops with the same one share supplier lookups
+    cache_folder: str
+    login_url: str
+    filter_url: str
+    export_url: str
+    download_url: str
+    logout_url: str
+    username: str
+    password: str
+    b1_api_key: str
+    prefix_supplier_map: dict = field(default_factory=dict, hash=False)
+    reporting_email: str = None
+    daily_email: str = None
+    pos_session_file: str = None
+
+    @property
+    def mapping_csv(self) -> str:
+        return os.path.join(self.cache_folder, "mapping.csv")
+
+    @property
+    def is_default(self) -> bool:
+        return self.key == DEFAULT_SHOP_KEY
+
+
+DEFAULT_SHOP_KEY = "default"
+_default_shop = None
+
+def default_shop() -> ShopConfig:
+    """The shop described by the environment variables above, i.e. the single-shop setup."""
+    global _default_shop
+    if _default_shop is None:
+        _default_shop = ShopConfig(
+            key=DEFAULT_SHOP_KEY,
+            name=SHOP_NAME,
+            data_folder=DATA_FOLDER,
+            cache_folder=DATA_FOLDER,
+            login_url=LOGIN_URL,
+            filter_url=FILTER_URL,
+            export_url=EXPORT_URL,
+            download_url=DOWNLOAD_URL,
+            logout_url=LOGOUT_URL,
+            username=USERNAME,
+            password=PASSWORD,
+            b1_api_key=B1_API_KEY,
+            prefix_supplier_map=sys.modules[__name__].PREFIX_SUPPLIER_MAP,
+            reporting_email=REPORTING_EMAIL,
+            daily_email=DAILY_EMAIL,
+            pos_session_file=POS_SESSION_FILE,
+        )
+    return _default_shop
+
+def load_shops() -> list:
+    """
+    The shops listed in SHOPS, or just the default shop without it. Each entry is an object with
+    ShopConfig fields and at least a "key"; the fields it leaves out come from the default shop,
+    except that the shop gets its own data folder (DATA_FOLDER/shops/<key>) and, if saved POS
+    sessions are used, its own session file there; the folders are created if missing.
+    By default all shops share mapping.csv and the supplier cache in DATA_FOLDER; a shop with
+    another B1 account (other product codes) should set its own cache_folder.
+    """
+    if not SHOPS:
+        return [default_shop()]
+    import json
+    if os.path.exists(SHOPS):
+        with open(SHOPS, encoding="utf-8") as f:
+            entries = json.load(f)
+    else:
+        entries = json.loads(SHOPS)
+
+    base = default_shop()
+    shops = []
+    for entry in entries:
+        entry = dict(entry)
+        entry.setdefault("name", entry["key"])
+        entry.setdefault("data_folder", os.path.join(DATA_FOLDER, "shops", entry["key"]))
+        if base.pos_session_file:
+            entry.setdefault("pos_session_file", os.path.join(entry["data_folder"], "pos_session.json"))
+        shop = replace(base, **entry)
+        os.makedirs(shop.data_folder, exist_ok=True)
+        os.makedirs(shop.cache_folder, exist_ok=True)
+        shops.append(shop)
+    return shops
@@ -1,8 +1,35 @@
-from io import StringIO
+import gzip
+import io
 import os
+import time
+import numpy as np
 import pandas as pd
-from prefix_mapping import get_supplier_by_prefix
-from b1_api import get_supplier_by_barcode
+from pandas.api.types import union_categoricals
+import metrics
+from prefix_mapping import get_suppliers_by_prefix
+from b1_api import get_suppliers_by_barcodes, get_supplier_cache
+
+# Columns of the Transactions export that the sales report needs
+TRANSACTION_COLUMNS = [
+    'Ar aktyvus?', 'Ar čekis atmestas?', 'Nuol. suma 1',
+    'Darb. vardas', 'Čekio nr.', 'Prekės kodas', 'Prekės pavadinimas',
+    'Kiekis', 'Pagr. kaina', 'Pagr. suma', 'Suma', 'Mok. suma', 'Įrašo data'
+]
+# Columns of the processed (discounted, supplier-mapped) sales
+SALES_COLUMNS = [
+    'Darb. vardas', 'Čekio nr.', 'Prekės kodas', 'Tiekėjas', 'Prekės pavadinimas',
+    'Kiekis', 'Pagr. kaina', 'Pagr. suma', 'Suma', 'Mok. suma', 'Nuolaida', 'Įrašo data'
+]
+# Compact dtypes of the Transactions columns, applied while parsing: flags fit in int8 and the
+# few distinct employee and product names are stored once as categories. Money stays float64
+# so sums and means in the report do not change.
+TRANSACTIONS_SCHEMA = {
+    'Ar aktyvus?': 'int8',
+    'Ar čekis atmestas?': 'int8',
+    'Darb. vardas': 'category',
+    'Prekės pavadinimas': 'category',
+}
+TRANSACTIONS_DATE_COLUMNS = ['Įrašo data']
 
 def convert_decimal(x):
     """Converts a string to a float, replacing commas with dots."""
@@ -12,15 +39,185 @@ def convert_decimal(x):
         return 0
 
 
-def read_csv_windows1257(file_path: str, sep=';', decimal=',', thousands='\xa0') -> pd.DataFrame:
-    """Reads a CSV file with Windows-1257 encoding."""
+class NbspStrippingReader(io.RawIOBase):
+    """
+    Binary reader that drops non-breaking spaces while reading.
+    Windows-1257 is a single-byte encoding, so NBSP is always the 0xA0 byte.
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            chunk = self.source.read(len(buffer))
+            if not chunk:
+                return 0
+            chunk = chunk.replace(b'\xa0', b'')
+            if chunk:
+                break
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+        super().close()
+
+
+def open_windows1257(file_path) -> io.TextIOWrapper:
+    """Opens a Windows-1257 file (path or binary file object) as text, without NBSPs, decoding as it is read."""
+    source = open(file_path, 'rb') if isinstance(file_path, (str, os.PathLike)) else file_path
+    return io.TextIOWrapper(io.BufferedReader(NbspStrippingReader(source)), encoding='Windows-1257')
+
+
+def iter_csv_chunks(file_path, chunksize: int, **read_csv_kwargs):
+    """
+    Yields DataFrames of up to chunksize rows from a Windows-1257 CSV file (or binary stream).
+    The time spent parsing them is recorded as the csv.parse stage, summed over the chunks;
+    a download stream's wait for the network is left out (it is pos.download, see DownloadStream).
+    """
+    seconds = 0.0
+    waited = getattr(file_path, 'read_seconds', 0.0)
+    try:
+        with open_windows1257(file_path) as text, \
+                pd.read_csv(text, chunksize=chunksize, **read_csv_kwargs) as reader:
+            while True:
+                started = time.perf_counter()
+                try:
+                    chunk = next(reader)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - started
+                yield chunk
+    finally:
+        seconds -= getattr(file_path, 'read_seconds', 0.0) - waited
+        metrics.record_stage("csv.parse", seconds)
+
+
+def read_csv_windows1257(file_path, sep=';', decimal=',', thousands='\xa0',
+                         usecols=None, dtype=None, parse_dates=None, chunksize=None):
+    """
+    Reads a CSV file with Windows-1257 encoding.
+    The file is decoded and cleaned while pandas parses it, so it is never held in memory as text.
+    With chunksize set, an iterator of DataFrames is returned instead.
+    """
     ##### Inconsistencies that decimal operator cannot pick up 
     ##### 1 ,000 might be used instead of 1,000
-    # Preprocess the file and replace non-breaking spaces
-    with open(file_path, 'r', encoding='Windows-1257') as f:
-        content = f.read().replace('\xa0', '')
+    # Non-breaking spaces are dropped on the fly
+    read_csv_kwargs = dict(sep=sep, decimal=decimal, thousands=thousands, usecols=usecols, dtype=dtype,
+                           parse_dates=parse_dates)
+    if chunksize:
+        return iter_csv_chunks(file_path, chunksize, **read_csv_kwargs)
+    with open_windows1257(file_path) as text:
+        return pd.read_csv(text, **read_csv_kwargs)
+
+def sidecar_path(csv_path: str) -> str:
+    """Path of the columnar (Feather) copy of a POS export."""
+    return os.path.splitext(csv_path)[0] + '.feather'
+
+
+class SidecarWriter:
+    """
+    Writes DataFrame chunks into an Arrow IPC (Feather v2) file, uncompressed so it can be memory-mapped.
+    The first chunk fixes the schema; if a later chunk cannot be cast to it, the sidecar is dropped.
+    Categorical columns are stored as plain strings, since each chunk has its own categories
+    and the IPC file format allows only one dictionary per column.
+    The file only appears under its final name once it is complete.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.schema = None
+        self.writer = None
+        self.failed = False
+
+    def write(self, df: pd.DataFrame) -> None:
+        if self.failed:
+            return
+        import pyarrow as pa
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            for i, field in enumerate(table.schema):
+                if pa.types.is_dictionary(field.type):
+                    table = table.set_column(i, field.name, table.column(i).cast(field.type.value_type))
+            if self.writer is None:
+                self.schema = table.schema
+                self.writer = pa.ipc.new_file(self.tmp_path, self.schema)
+            else:
+                table = table.cast(self.schema)
+            self.writer.write_table(table)
+        except (pa.ArrowException, ValueError, TypeError) as e:
+            print(f"Could not write {self.path}: {e}")
+            self.abort()
+
+    def close(self) -> None:
+        if self.failed or self.writer is None:
+            return
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        self.failed = True
+        if self.writer is not None:
+            self.writer.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def iter_export_chunks(csv_path: str, columns=None, chunksize=100_000, source=None, **read_csv_kwargs):
+    """
+    Yields a POS export as DataFrames. When its Feather sidecar is up to date the batches are
+    read from it memory-mapped; otherwise the CSV is parsed and the sidecar is written from the
+    same chunks. Without pyarrow installed, this just reads the CSV.
+    source can be a binary stream of the export still being downloaded to csv_path
+    (see POSClient.download_stream); it is parsed instead of the file.
+    Only the given columns are parsed, and only they go into the sidecar; a sidecar missing
+    some of the columns asked for is rewritten from the CSV.
+    The dtype in read_csv_kwargs is applied to the sidecar batches as well.
+    """
+    source = csv_path if source is None else source
+    dtype = read_csv_kwargs.get('dtype') or {}
+    try:
+        import pyarrow as pa
+    except ImportError:
+        yield from read_csv_windows1257(source, usecols=columns, chunksize=chunksize, **read_csv_kwargs)
+        return
+
+    feather_path = sidecar_path(csv_path)
+    if source is csv_path and os.path.exists(feather_path) and \
+            os.path.getmtime(feather_path) >= os.path.getmtime(csv_path):
+        with pa.memory_map(feather_path) as mapped:
+            reader = pa.ipc.open_file(mapped)
+            if columns is None or set(columns) <= set(reader.schema.names):
+                # a header-only export has no batches, only the schema; it still gives one empty frame
+                batches = [reader.get_batch(i) for i in range(reader.num_record_batches)] or \
+                    [pa.RecordBatch.from_pylist([], schema=reader.schema)]
+                for batch in batches:
+                    if columns is not None:
+                        batch = batch.select(columns)
+                    chunk = batch.to_pandas()
+                    yield chunk.astype({column: dtype[column] for column in chunk.columns if column in dtype})
+                return
+
+    sidecar = SidecarWriter(feather_path)
+    try:
+        for chunk in read_csv_windows1257(source, usecols=columns, chunksize=chunksize, **read_csv_kwargs):
+            # usecols keeps the file's column order
+            chunk = chunk if columns is None else chunk[columns]
+            sidecar.write(chunk)
+            yield chunk
+    except BaseException:
+        # also covers a consumer that stops early: a partial sidecar is never kept
+        sidecar.abort()
+        raise
+    sidecar.close()
 
-    return pd.read_csv(StringIO(content), sep=sep, decimal=decimal, thousands=thousands)
 
 def filter_discounted_sales(df: pd.DataFrame) -> pd.DataFrame:
     """Filters the DataFrame for active checks with a discount."""
@@ -32,36 +229,273 @@ def filter_discounted_sales(df: pd.DataFrame) -> pd.DataFrame:
     ]
     return filtered_df
 
-def map_suppliers(df: pd.DataFrame, mapping_csv: str) -> pd.DataFrame:
-    """Adds a 'Tiekėjas' column by merging on Prekės kodas and does fallback prefix logic."""
+@metrics.timed("sales.map_suppliers")
+def map_suppliers(df: pd.DataFrame, mapping_csv: str, shop=None) -> pd.DataFrame:
+    """Adds a 'Tiekėjas' column by merging on Prekės kodas and does fallback prefix logic.
+
+    Suppliers are resolved once per distinct product code (mapping CSV, then
+    prefix, then B1 API) and joined back onto the rows. The prefixes and the B1 account
+    are the shop's (the default shop's if not given).
+    """
     # Load mapping CSV
     mapping_df = pd.read_csv(mapping_csv, encoding='utf-8')
     mapping_df['Prekės kodas'] = mapping_df['Prekės kodas'].astype(int)
+    mapping_df = mapping_df[['Prekės kodas', 'Tiekėjas']].drop_duplicates('Prekės kodas')
+
+    codes_df = pd.DataFrame({'Prekės kodas': df['Prekės kodas'].unique()})
+    codes_df = codes_df.merge(mapping_df, on='Prekės kodas', how='left')
 
-    df = df.merge(mapping_df, on='Prekės kodas', how='left')
-
-    # prefix-based && B1 API fallback
-    df['Tiekėjas'] = df.apply(
-        lambda row: row['Tiekėjas'] 
-        if pd.notnull(row['Tiekėjas']) 
-        else (
-            get_supplier_by_prefix(str(row['Prekės kodas'])) 
-            if get_supplier_by_prefix(str(row['Prekės kodas'])) is not None 
-            else get_supplier_by_barcode(str(row['Prekės kodas']))
-        ),
-        axis=1
+    # prefix-based fallback
+    missing = codes_df['Tiekėjas'].isna()
+    codes_df.loc[missing, 'Tiekėjas'] = get_suppliers_by_prefix(
+        codes_df.loc[missing, 'Prekės kodas'], shop.prefix_supplier_map if shop else None
     )
+
+    # B1 API fallback
+    missing = codes_df['Tiekėjas'].isna()
+    codes = codes_df.loc[missing, 'Prekės kodas'].astype(str)
+    codes_df.loc[missing, 'Tiekėjas'] = codes.map(get_suppliers_by_barcodes(codes, shop))
+    get_supplier_cache(shop).flush()
+
     # Fill in the remaining missing values
-    df['Tiekėjas'] = df['Tiekėjas'].fillna('Nežinomas')
-    return df
+    codes_df['Tiekėjas'] = codes_df['Tiekėjas'].fillna('Nežinomas').astype('category')
+    return df.merge(codes_df, on='Prekės kodas', how='left')
+
+def concat_frames(frames) -> pd.DataFrame:
+    """
+    Concatenates DataFrames like pd.concat, but columns that are categorical in every frame stay
+    categorical, with the sorted union of the frames' categories (pd.concat falls back to object).
+    """
+    frames = list(frames)
+    if not frames:
+        return pd.DataFrame()
+    for column in frames[0].columns:
+        parts = [frame[column] for frame in frames]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            if len({part.cat.categories.dtype for part in parts}) > 1:
+                # e.g. an empty or all-NA categorical has object categories, a filled one str
+                parts = [part.cat.rename_categories(part.cat.categories.astype(object)) for part in parts]
+            categories = union_categoricals(parts, sort_categories=True).categories
+            frames = [frame.assign(**{column: part.cat.set_categories(categories)}) for frame, part in zip(frames, parts)]
+    return pd.concat(frames, ignore_index=True)
+
+def clean_supplier_names(suppliers: pd.Series) -> pd.Series:
+    """
+    Drops company forms (UAB, AB) and quotes from supplier names and title-cases them.
+    For a categorical column only its categories are cleaned, then the codes are remapped.
+    """
+    def clean(names):
+        return (
+            names
+            .str.replace('UAB ', '', regex=False)
+            .str.replace('AB ', '', regex=False)
+            .str.replace('"', '', regex=False)
+            .str.title()
+        )
+
+    if not isinstance(suppliers.dtype, pd.CategoricalDtype):
+        return clean(suppliers)
+    cleaned = clean(suppliers.cat.categories.to_series()).to_numpy()
+    categories = pd.Index(pd.unique(cleaned)).sort_values()
+    # codes of the old categories in the cleaned ones; -1 (missing) stays -1
+    recode = np.append(categories.get_indexer(cleaned), -1)
+    codes = recode[suppliers.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=suppliers.index, name=suppliers.name)
+
+@metrics.timed("sales.prepare")
+def prepare_sales(chunks, mapping_csv: str, shop=None) -> pd.DataFrame:
+    """Keeps the discounted sales from Transactions export chunks and adds their suppliers."""
+    df = concat_frames(filter_discounted_sales(chunk) for chunk in chunks)
+    metrics.count("sales.discounted_rows", len(df))
+
+    df = df.rename(columns={'Nuol. suma 1': 'Nuolaida'})
+    df['Prekės kodas'] = df['Prekės kodas'].astype(int)
+
+    df = map_suppliers(df, mapping_csv=mapping_csv, shop=shop)
+    return df[SALES_COLUMNS]
 
 def summarize_discounts_by_supplier(df: pd.DataFrame) -> pd.DataFrame:
     """Group by 'Tiekėjas' and sum 'Nuolaida'."""
-    grouped_df = df.groupby('Tiekėjas')['Nuolaida'].sum().reset_index()
+    grouped_df = df.groupby('Tiekėjas', observed=True)['Nuolaida'].sum().reset_index()
     return grouped_df.sort_values(by='Nuolaida', ascending=False)
 
-def save_excel(df: pd.DataFrame, grouped_df: pd.DataFrame, output_path: str) -> None:
-    """Saves two sheets in one Excel file."""
-    with pd.ExcelWriter(output_path) as writer:
-        df.to_excel(writer, sheet_name='Pardavimai', index=False)
-        grouped_df.to_excel(writer, sheet_name='Sumiškai pagal tiekėją', index=False)
\ No newline at end of file
+def join_by_group(df: pd.DataFrame, keys: list, column: str, sep: str) -> pd.DataFrame:
+    """
+    Joins the strings of a column per group of keys, keeping the row order within each group.
+    The rows are put in group order with one stable sort, so there is no Python callback per group.
+    """
+    if df.empty:
+        return df[keys + [column]].reset_index(drop=True)
+    group_ids = df.groupby(keys, sort=False, observed=True).ngroup().to_numpy()
+    order = np.argsort(group_ids, kind='stable')
+    values = df[column].to_numpy()[order].tolist()
+    sorted_ids = group_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    ends = np.r_[starts[1:], len(values)]
+
+    joined = df.iloc[order[starts]][keys].reset_index(drop=True)
+    joined[column] = [sep.join(values[start:end]) for start, end in zip(starts, ends)]
+    return joined
+
+
+def aggregate_products(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sums up the sales per supplier and product ('Tiekėjas', 'Prekė'): mean price, quantity,
+    discount and the receipts, as 'nr, nr (employee, date); ...' where each employee and day
+    ('Employee_Date') lists its distinct receipt numbers in order of appearance.
+    Works with object or categorical keys.
+    """
+    keys = ['Tiekėjas', 'Prekė']
+
+    # distinct receipt numbers per employee/day and product
+    receipts = df[['Employee_Date', 'Prekė']].assign(**{'Čekio nr.': df['Čekio nr.'].astype(str)})
+    receipts = join_by_group(receipts.drop_duplicates(), ['Employee_Date', 'Prekė'], 'Čekio nr.', ', ')
+    receipts['Kvitai'] = receipts['Čekio nr.'] + ' (' + receipts['Employee_Date'].astype(str) + ')'
+
+    # each employee/day once per product, in order of appearance
+    visits = df[keys + ['Employee_Date']].drop_duplicates()
+    visits = visits.merge(receipts[['Employee_Date', 'Prekė', 'Kvitai']], on=['Employee_Date', 'Prekė'], how='left')
+    kvitai = join_by_group(visits, keys, 'Kvitai', '; ')
+
+    products_df = df.groupby(keys, observed=True).agg({
+        'Pagr. kaina': 'mean',
+        'Kiekis': 'sum',
+        'Nuolaida': 'sum',
+    }).reset_index()
+    products_df = products_df.merge(kvitai, on=keys, how='left')
+    return products_df.rename(columns={'Nuolaida': 'Nuol.', 'Pagr. kaina': 'Kaina'})
+
+# Number formats of the Excel sheets and how many rows are converted for writing at a time
+EXCEL_DATE_FORMAT = 'yyyy-mm-dd hh:mm:ss'
+EXCEL_MONEY_FORMAT = '0.00'
+EXCEL_BLOCK_ROWS = 10_000
+
+
+def iter_row_blocks(df: pd.DataFrame, rows: int = EXCEL_BLOCK_ROWS):
+    """Yields the DataFrame in blocks of rows (an empty DataFrame once, so headers still get written)."""
+    for start in range(0, max(len(df), 1), rows):
+        yield df.iloc[start:start + rows]
+
+def block_values(block: pd.DataFrame) -> list:
+    """Rows of a block as lists of Python values; missing values become None (blank cells)."""
+    return block.astype(object).where(block.notna(), None).to_numpy().tolist()
+
+def excel_number_formats(df: pd.DataFrame) -> list:
+    """Number format of each column: dates and money get fixed formats, the rest stay General."""
+    return [
+        EXCEL_DATE_FORMAT if pd.api.types.is_datetime64_any_dtype(dtype)
+        else EXCEL_MONEY_FORMAT if pd.api.types.is_float_dtype(dtype)
+        else None
+        for dtype in df.dtypes
+    ]
+
+
+class CsvGzOutput:
+    """Writes DataFrame blocks into one gzip-compressed CSV."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = gzip.open(path, 'wt', encoding='utf-8', newline='')
+        self.header = True
+
+    def write(self, block: pd.DataFrame) -> None:
+        block.to_csv(self.file, index=False, header=self.header)
+        self.header = False
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetOutput:
+    """Writes DataFrame blocks into one Parquet file, one row group per block."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.writer = None
+
+    def write(self, block: pd.DataFrame) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(block, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+# Sales formats that save_excel can write next to the workbook, by file extension
+EXTRA_OUTPUTS = {
+    'csv.gz': CsvGzOutput,
+    'parquet': ParquetOutput,
+}
+
+
+def write_xlsxwriter_sheet(workbook, sheet_name: str, df: pd.DataFrame, outputs=()) -> None:
+    """Streams a DataFrame into a new sheet of a constant-memory xlsxwriter workbook."""
+    sheet = workbook.add_worksheet(sheet_name)
+    number_formats = excel_number_formats(df)
+    formats = [workbook.add_format({'num_format': f}) if f else None for f in number_formats]
+    for col, column in enumerate(df.columns):
+        width = 20 if number_formats[col] == EXCEL_DATE_FORMAT else max(len(str(column)) + 2, 10)
+        sheet.set_column(col, col, width)
+    sheet.write_row(0, 0, [str(column) for column in df.columns], workbook.add_format({'bold': True}))
+
+    # consecutive columns with the same format are written with one write_row call
+    segments = []
+    for col, cell_format in enumerate(formats):
+        if segments and segments[-1][2] is cell_format:
+            segments[-1][1] = col + 1
+        else:
+            segments.append([col, col + 1, cell_format])
+
+    row = 1
+    for block in iter_row_blocks(df):
+        for output in outputs:
+            output.write(block)
+        for values in block_values(block):
+            for start, end, cell_format in segments:
+                sheet.write_row(row, start, values[start:end], cell_format)
+            row += 1
+
+def write_openpyxl_sheet(workbook, sheet_name: str, df: pd.DataFrame, outputs=()) -> None:
+    """Streams a DataFrame into a new sheet of a write-only openpyxl workbook (dates get openpyxl's format)."""
+    sheet = workbook.create_sheet(sheet_name)
+    sheet.append([str(column) for column in df.columns])
+    for block in iter_row_blocks(df):
+        for output in outputs:
+            output.write(block)
+        for values in block_values(block):
+            sheet.append(values)
+
+@metrics.timed("report.excel")
+def save_excel(df: pd.DataFrame, grouped_df: pd.DataFrame, output_path: str, extra_formats=()) -> None:
+    """
+    Saves two sheets in one Excel file.
+    Rows are streamed into a write-only workbook (xlsxwriter in constant-memory mode, or openpyxl
+    without it), so the workbook is never built in memory. Each format in extra_formats
+    ('csv.gz', 'parquet') also gets the sales written next to the workbook, in the same pass.
+    """
+    base_path = os.path.splitext(output_path)[0]
+    outputs = [EXTRA_OUTPUTS[extension](f"{base_path}.{extension}") for extension in extra_formats]
+    try:
+        try:
+            import xlsxwriter
+        except ImportError:
+            from openpyxl import Workbook
+            workbook = Workbook(write_only=True)
+            write_openpyxl_sheet(workbook, 'Pardavimai', df, outputs)
+            write_openpyxl_sheet(workbook, 'Sumiškai pagal tiekėją', grouped_df)
+            workbook.save(output_path)
+        else:
+            workbook = xlsxwriter.Workbook(output_path, {'constant_memory': True})
+            write_xlsxwriter_sheet(workbook, 'Pardavimai', df, outputs)
+            write_xlsxwriter_sheet(workbook, 'Sumiškai pagal tiekėją', grouped_df)
+            workbook.close()
+    finally:
+        for output in outputs:
+            output.close()
+    for output in outputs:
+        print(f"Sales exported to {output.path}")
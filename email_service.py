@@ -1,43 +1,348 @@
-from email import encoders
-from email.mime.base import MIMEBase
+"""
+Outgoing mail goes through a local outbox: send_email_html writes the message to OUTBOX_FOLDER
+and returns, and a background thread delivers the outbox over one SMTP connection.
+Messages that could not be delivered are retried with backoff by later runs, or by
+running this module (e.g. from cron):
+
+    python email_service.py [--force]
+
+For testing, point SMTP_SERVER/SMTP_PORT at a local debugging server, set SMTP_STARTTLS=0
+and leave SMTP_USER empty, e.g. with `python -m aiosmtpd -n -l localhost:1025`.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import shutil
 import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from email.header import Header
+from email.utils import encode_rfc2231, formatdate, make_msgid
 
-from config import FROM_EMAIL, SMTP_USER, SMTP_PASS, SMTP_SERVER, SMTP_PORT
+import metrics
+from config import (
+    FROM_EMAIL, SMTP_USER, SMTP_PASS, SMTP_SERVER, SMTP_PORT, SMTP_STARTTLS, SMTP_TIMEOUT,
+    OUTBOX_FOLDER, SMTP_RETRY_SECONDS, SMTP_MAX_ATTEMPTS
+)
 
-def send_email_html(
-    subject: str, 
-    to_email: str, 
-    html_content: str, 
+# Attachments are read and encoded this many bytes at a time (a multiple of 57: whole base64 lines)
+ENCODE_CHUNK_SIZE = 57 * 1024
+# Message data is sent to the server in pieces of about this size
+SEND_BUFFER_SIZE = 64 * 1024
+# Longest wait between two delivery attempts of a message, seconds
+MAX_RETRY_SECONDS = 6 * 3600
+
+
+def write_base64(f, source) -> None:
+    """Writes a binary stream as base64 lines (CRLF-terminated), a chunk at a time."""
+    while True:
+        chunk = source.read(ENCODE_CHUNK_SIZE)
+        if not chunk:
+            break
+        f.write(base64.encodebytes(chunk).replace(b"\n", b"\r\n"))
+
+def write_headers(f, headers: list) -> None:
+    for name, value in headers:
+        f.write(f"{name}: {value}\r\n".encode("ascii"))
+    f.write(b"\r\n")
+
+def attachment_disposition(name: str) -> str:
+    if name.isascii():
+        return f'attachment; filename="{name}"'
+    return f"attachment; filename*={encode_rfc2231(name, 'utf-8')}"
+
+def message_paths(message_id: str):
+    """The message file (.eml) and its delivery state (.json) in the outbox."""
+    base = os.path.join(OUTBOX_FOLDER, message_id)
+    return base + ".eml", base + ".json"
+
+def write_state(state_path: str, state: dict) -> None:
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_path + ".tmp", state_path)
+
+
+@metrics.timed("email.spool")
+def spool_email_html(
+    subject: str,
+    to_email: str,
+    html_content: str,
     cc_email: str = None,
     attachments: list = None
-):
-    msg = MIMEMultipart()
-    msg['From'] = FROM_EMAIL
-    msg['To'] = to_email
+) -> str:
+    """
+    Writes a message into the outbox and returns its path. Attachments are base64-encoded
+    straight from their files into the message file, a chunk at a time.
+    """
+    os.makedirs(OUTBOX_FOLDER, exist_ok=True)
+    # ids sort in the order the messages were queued
+    message_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**9:09d}-{uuid.uuid4().hex[:6]}"
+    eml_path, state_path = message_paths(message_id)
+    boundary = f"=={uuid.uuid4().hex}=="
+
+    headers = [("From", FROM_EMAIL), ("To", to_email)]
     if cc_email:
-        msg['Cc'] = cc_email
-    msg['Subject'] = subject
-
-    msg.attach(MIMEText(html_content, 'html'))
-
-    if attachments:
-        for attachment in attachments:
-            with open(attachment, "rb") as f:
-                part = MIMEBase("application", "octet-stream")
-                part.set_payload(f.read())
-            encoders.encode_base64(part)
-            name = attachment.split("/")[-1]
-            part.add_header(
-                "Content-Disposition",
-                f"attachment; filename= {name}",
-            )
-            msg.attach(part)
-            
-
-    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-    server.starttls()
-    server.login(SMTP_USER, SMTP_PASS)
-    server.sendmail(FROM_EMAIL, [to_email] + ([cc_email] if cc_email else []), msg.as_string())
-    server.quit()
\ No newline at end of file
+        headers.append(("Cc", cc_email))
+    headers += [
+        ("Subject", Header(subject, "utf-8").encode().replace("\n", "\r\n")),
+        ("Date", formatdate(localtime=True)),
+        ("Message-ID", make_msgid()),
+        ("MIME-Version", "1.0"),
+        ("Content-Type", f'multipart/mixed; boundary="{boundary}"'),
+    ]
+    with open(eml_path + ".tmp", "wb") as f:
+        write_headers(f, headers)
+        f.write(f"--{boundary}\r\n".encode())
+        write_headers(f, [("Content-Type", 'text/html; charset="utf-8"'), ("Content-Transfer-Encoding", "base64")])
+        write_base64(f, io.BytesIO(html_content.encode("utf-8")))
+        for attachment in attachments or []:
+            f.write(f"--{boundary}\r\n".encode())
+            write_headers(f, [
+                ("Content-Type", "application/octet-stream"),
+                ("Content-Transfer-Encoding", "base64"),
+                ("Content-Disposition", attachment_disposition(os.path.basename(attachment))),
+            ])
+            with open(attachment, "rb") as source:
+                write_base64(f, source)
+        f.write(f"--{boundary}--\r\n".encode())
+
+    write_state(state_path, {
+        "from": FROM_EMAIL,
+        "to": [to_email] + ([cc_email] if cc_email else []),
+        "subject": subject,
+        "attempts": 0,
+        "next_attempt": 0,
+        "last_error": None,
+    })
+    # the message only counts as queued once it is complete
+    os.replace(eml_path + ".tmp", eml_path)
+    return eml_path
+
+
+@metrics.timed("smtp.connect")
+def open_connection() -> smtplib.SMTP:
+    """Connects (STARTTLS and login when configured) to the SMTP server."""
+    server = smtplib.SMTP(SMTP_SERVER, int(SMTP_PORT), timeout=SMTP_TIMEOUT)
+    server.ehlo()
+    if SMTP_STARTTLS:
+        server.starttls()
+        server.ehlo()
+    if SMTP_USER:
+        server.login(SMTP_USER, SMTP_PASS)
+    return server
+
+@metrics.timed("smtp.send")
+def send_spooled(server: smtplib.SMTP, eml_path: str, state: dict) -> None:
+    """
+    Sends one message file over an open connection. The DATA is streamed from the file
+    (dot-stuffed on the way) instead of being read into memory.
+    Raises the smtplib exception of a refused message.
+    """
+    code, response = server.mail(state["from"])
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, response, state["from"])
+    refused = {}
+    for recipient in state["to"]:
+        code, response = server.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, response)
+    if len(refused) == len(state["to"]):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    server.putcmd("data")
+    code, response = server.getreply()
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, response)
+    with open(eml_path, "rb") as f:
+        buffer, size = [], 0
+        for line in f:
+            if line.startswith(b"."):
+                line = b"." + line
+            buffer.append(line)
+            size += len(line)
+            if size >= SEND_BUFFER_SIZE:
+                server.send(b"".join(buffer))
+                buffer, size = [], 0
+        buffer.append(b".\r\n")
+        server.send(b"".join(buffer))
+    code, response = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+
+def is_permanent(error: Exception) -> bool:
+    """Whether the server refused the message for good (5xx), so retrying is pointless."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+@contextmanager
+def outbox_lock():
+    """Holds the outbox lock, so two processes never deliver the same message; yields whether it was taken."""
+    try:
+        import fcntl
+    except ImportError:
+        yield True
+        return
+    with open(os.path.join(OUTBOX_FOLDER, ".lock"), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        yield True
+
+def due_messages(force: bool = False) -> list:
+    """Ids of the queued messages whose next attempt is due, oldest first."""
+    if not os.path.isdir(OUTBOX_FOLDER):
+        return []
+    now = time.time()
+    due = []
+    for name in sorted(os.listdir(OUTBOX_FOLDER)):
+        if not name.endswith(".eml"):
+            continue
+        message_id = name[:-4]
+        with open(message_paths(message_id)[1]) as f:
+            state = json.load(f)
+        if force or state["next_attempt"] <= now:
+            due.append(message_id)
+    return due
+
+def deliver_outbox(force: bool = False) -> int:
+    """
+    Delivers the due messages of the outbox over one SMTP connection and returns how many
+    were sent. A failed message is retried later with backoff, and after SMTP_MAX_ATTEMPTS
+    (or when it is refused for good) moved to the outbox's failed folder. If the server cannot
+    be reached or the connection breaks, the rest waits for the next run. With force, backoff is ignored.
+    """
+    if not os.path.isdir(OUTBOX_FOLDER):
+        return 0
+    sent = 0
+    with outbox_lock() as locked:
+        if not locked:
+            return 0
+        server = None
+        tried = set()
+        try:
+            # messages spooled during the pass are picked up too
+            while True:
+                pending = [message_id for message_id in due_messages(force) if message_id not in tried]
+                if not pending:
+                    break
+                for message_id in pending:
+                    tried.add(message_id)
+                    eml_path, state_path = message_paths(message_id)
+                    with open(state_path) as f:
+                        state = json.load(f)
+                    if server is None:
+                        try:
+                            server = open_connection()
+                        except (smtplib.SMTPException, OSError) as e:
+                            # server down or login refused: everything waits for the next run
+                            print(f"Could not connect to {SMTP_SERVER}: {e}")
+                            return sent
+                    try:
+                        send_spooled(server, eml_path, state)
+                    except smtplib.SMTPServerDisconnected as e:
+                        retry_later(message_id, state, e)
+                        return sent
+                    except smtplib.SMTPException as e:
+                        # refused by the server; the connection can still be used
+                        retry_later(message_id, state, e)
+                        continue
+                    except OSError as e:
+                        # the connection broke (SMTPException is an OSError too, so this comes last)
+                        retry_later(message_id, state, e)
+                        return sent
+                    os.remove(eml_path)
+                    os.remove(state_path)
+                    sent += 1
+                    metrics.count("email.sent")
+                    print(f"Email sent: {state['subject']}")
+        finally:
+            if server is not None:
+                try:
+                    server.quit()
+                except (smtplib.SMTPException, OSError):
+                    server.close()
+    return sent
+
+def retry_later(message_id: str, state: dict, error: Exception) -> None:
+    """Records a failed attempt: the message gets a later next attempt, or goes to failed/."""
+    state["attempts"] += 1
+    state["last_error"] = f"{type(error).__name__}: {error}"
+    metrics.count("email.not_delivered")
+    eml_path, state_path = message_paths(message_id)
+    if is_permanent(error) or state["attempts"] >= SMTP_MAX_ATTEMPTS:
+        failed_folder = os.path.join(OUTBOX_FOLDER, "failed")
+        os.makedirs(failed_folder, exist_ok=True)
+        write_state(state_path, state)
+        shutil.move(state_path, os.path.join(failed_folder, os.path.basename(state_path)))
+        shutil.move(eml_path, os.path.join(failed_folder, os.path.basename(eml_path)))
+        print(f"Email '{state['subject']}' not delivered, moved to {failed_folder}: {state['last_error']}")
+        return
+    delay = min(SMTP_RETRY_SECONDS * 2 ** (state["attempts"] - 1), MAX_RETRY_SECONDS)
+    state["next_attempt"] = time.time() + delay
+    write_state(state_path, state)
+    print(f"Email '{state['subject']}' not delivered ({state['last_error']}), retrying in {delay:.0f} s.")
+
+
+# The background sender; a non-daemon thread, so queued mail is delivered before the program exits
+sender_thread = None
+sender_lock = threading.Lock()
+sender_wakeup = threading.Event()
+
+def run_sender() -> None:
+    global sender_thread
+    while True:
+        with sender_lock:
+            if not sender_wakeup.is_set():
+                sender_thread = None
+                return
+            sender_wakeup.clear()
+        try:
+            with metrics.run("email"):
+                deliver_outbox()
+        except Exception as e:
+            print(f"Email delivery failed: {e}")
+
+def start_sender() -> None:
+    """Makes the background sender go through the outbox (starting it if it is not running)."""
+    global sender_thread
+    with sender_lock:
+        sender_wakeup.set()
+        if sender_thread is None:
+            sender_thread = threading.Thread(target=run_sender, name="email-outbox")
+            sender_thread.start()
+
+
+def send_email_html(
+    subject: str,
+    to_email: str,
+    html_content: str,
+    cc_email: str = None,
+    attachments: list = None
+) -> str:
+    """
+    Queues an HTML email (with file attachments) in the outbox and returns its path right away;
+    it is delivered by the background sender.
+    """
+    eml_path = spool_email_html(subject, to_email, html_content, cc_email=cc_email, attachments=attachments)
+    start_sender()
+    return eml_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deliver the queued emails of the outbox.")
+    parser.add_argument("--force", action="store_true", help="retry now, ignoring backoff")
+    args = parser.parse_args()
+    with metrics.run("email"):
+        sent = deliver_outbox(force=args.force)
+    print(f"{sent} sent, {len(due_messages(force=True))} still queued.")
@@ -0,0 +1,125 @@
+import os
+import stat
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from mimetypes import guess_type
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response
+from config import FILE_STAT_TTL
+
+# Precompressed siblings of a file, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+class FileInfo:
+    """What a response needs to know about a file, from one os.stat."""
+
+    def __init__(self, path: str, stat_result: os.stat_result):
+        self.path = path
+        self.mtime = stat_result.st_mtime
+        self.size = stat_result.st_size
+        # strong validator: changes whenever the file is rewritten
+        self.etag = f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+        self.last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+
+
+class FileStatCache:
+    """Caches FileInfo (or that the file is missing) per path for ttl seconds."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, path: str):
+        now = time.monotonic()
+        entry = self.entries.get(path)
+        if entry is not None and now - entry[0] < self.ttl:
+            return entry[1]
+        try:
+            stat_result = os.stat(path)
+            info = FileInfo(path, stat_result) if stat.S_ISREG(stat_result.st_mode) else None
+        except OSError:
+            info = None
+        with self.lock:
+            self.entries[path] = (now, info)
+        return info
+
+    def refresh(self, path: str):
+        """Like get, but checks the file again even if its entry has not expired."""
+        with self.lock:
+            self.entries.pop(path, None)
+        return self.get(path)
+
+
+FILE_CACHE = FileStatCache(FILE_STAT_TTL)
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    """Content codings the client accepts (q=0 excluded)."""
+    accepted = set()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+def is_not_modified(request: Request, info: FileInfo) -> bool:
+    """Whether the client's cached copy is current (If-None-Match, or else If-Modified-Since)."""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or info.etag in tags
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(info.mtime) <= since
+    return False
+
+def file_response(request: Request, path: str) -> Response:
+    """
+    Serves a file with ETag and Last-Modified, answering conditional requests with 304.
+    A .br or .gz sibling at least as new as the file is sent instead when the client accepts it.
+    Range requests are handled by FileResponse. File metadata comes from FILE_CACHE.
+    """
+    info = FILE_CACHE.get(path)
+    if info is None:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    accepted = accepted_encodings(request.headers.get('accept-encoding', ''))
+    chosen, encoding, has_variants = info, None, False
+    for coding, suffix in ENCODINGS:
+        variant = FILE_CACHE.get(path + suffix)
+        if variant is None or variant.mtime < info.mtime:
+            continue
+        has_variants = True
+        if encoding is None and coding in accepted:
+            chosen, encoding = variant, coding
+
+    headers = {
+        'ETag': chosen.etag,
+        'Last-Modified': chosen.last_modified,
+        # reports are rewritten when a week is reprocessed, so always revalidate
+        'Cache-Control': 'no-cache',
+    }
+    if has_variants:
+        headers['Vary'] = 'Accept-Encoding'
+    if is_not_modified(request, chosen):
+        return Response(status_code=304, headers=headers)
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+
+    media_type = guess_type(path)[0] or 'application/octet-stream'
+    # the file is stat'ed again when sent, so Content-Length always matches what is read
+    return FileResponse(chosen.path, headers=headers, media_type=media_type)
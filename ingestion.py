@@ -0,0 +1,108 @@
+import os
+from datetime import date, datetime, time, timedelta
+import pandas as pd
+
+import metrics
+from pos_client import export_grids
+from config import default_shop
+from data_processing import (
+    TRANSACTION_COLUMNS,
+    TRANSACTIONS_SCHEMA,
+    TRANSACTIONS_DATE_COLUMNS,
+    SALES_COLUMNS,
+    concat_frames,
+    iter_export_chunks,
+    prepare_sales
+)
+
+def partition_folder(shop=None) -> str:
+    """Where the shop keeps one raw export and one processed partition per day."""
+    return os.path.join((shop or default_shop()).data_folder, "transactions")
+
+
+def day_paths(day: date, shop=None):
+    """Raw export and processed partition paths of one day (the export's sidecar is {day}.feather)."""
+    name = day.strftime('%Y-%m-%d')
+    folder = partition_folder(shop)
+    return os.path.join(folder, f"{name}.csv"), os.path.join(folder, f"{name}_sales.feather")
+
+
+def written_after_day(path: str, day: date) -> bool:
+    """Whether the file exists and was written after the day was over, so it holds the whole day."""
+    end_of_day = datetime.combine(day + timedelta(days=1), time())
+    return os.path.exists(path) and datetime.fromtimestamp(os.path.getmtime(path)) >= end_of_day
+
+
+def partition_is_fresh(day: date, shop=None) -> bool:
+    """A partition is reused while it holds the whole day and is newer than mapping.csv."""
+    _, partition_path = day_paths(day, shop)
+    if not written_after_day(partition_path, day):
+        return False
+    mapping_csv = (shop or default_shop()).mapping_csv
+    return not os.path.exists(mapping_csv) or os.path.getmtime(partition_path) >= os.path.getmtime(mapping_csv)
+
+
+def needs_download(day: date, shop=None) -> bool:
+    raw_path, _ = day_paths(day, shop)
+    return not partition_is_fresh(day, shop) and not written_after_day(raw_path, day)
+
+
+def process_day(day: date, shop=None) -> pd.DataFrame:
+    """Filters and supplier-maps the day's downloaded export and stores it as the day's partition."""
+    shop = shop or default_shop()
+    raw_path, partition_path = day_paths(day, shop)
+    chunks = iter_export_chunks(raw_path, columns=TRANSACTION_COLUMNS,
+                                dtype=TRANSACTIONS_SCHEMA, parse_dates=TRANSACTIONS_DATE_COLUMNS)
+    df = prepare_sales(chunks, mapping_csv=shop.mapping_csv, shop=shop)
+
+    tmp_path = partition_path + '.tmp'
+    df.to_feather(tmp_path)
+    os.replace(tmp_path, partition_path)
+    print(f"Partition {partition_path} saved ({len(df)} rows).")
+    return df
+
+
+def load_partitions(start_date: date, end_date: date, shop=None):
+    """
+    Concatenates the daily partitions of a date range (days in the future are skipped),
+    ingesting the days that are missing or stale. Missing days are downloaded concurrently.
+    Returns the sales and the path of the newest partition; for a range entirely in the future,
+    no sales and None.
+    """
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    days = [day for day in days if day <= date.today()]
+    if not days:
+        return pd.DataFrame(columns=SALES_COLUMNS), None
+
+    jobs = {
+        day: {
+            "grid": "Transactions",
+            "date_from": day.strftime('%Y-%m-%d 00:00'),
+            "date_to": (day + timedelta(days=1)).strftime('%Y-%m-%d 00:00'),
+            "file_path": day_paths(day, shop)[0],
+            "columns": TRANSACTION_COLUMNS,
+        }
+        for day in days if needs_download(day, shop)
+    }
+    if jobs:
+        os.makedirs(partition_folder(shop), exist_ok=True)
+        for day, result in export_grids(jobs, shop=shop).items():
+            if isinstance(result, Exception):
+                raise RuntimeError(f"Could not download Transactions of {day}") from result
+
+    frames = [
+        pd.read_feather(day_paths(day, shop)[1]) if partition_is_fresh(day, shop) else process_day(day, shop)
+        for day in days
+    ]
+    # days without sales (holidays, closed days) add nothing, and their empty categoricals
+    # would not merge with the others'; one is kept if the whole range was empty
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    return concat_frames(frames), day_paths(days[-1], shop)[1]
+
+
+if __name__ == "__main__":
+    # Ingest yesterday and whatever is missing of the current week before it
+    yesterday = date.today() - timedelta(days=1)
+    week_start = yesterday - timedelta(days=yesterday.weekday())
+    with metrics.run("ingestion"):
+        load_partitions(week_start, yesterday)
@@ -1,7 +1,9 @@
 from config import DATA_FOLDER, HOST, PORT, SSL_KEYFILE, SSL_CERTFILE
 from datetime import datetime
-from fastapi import FastAPI, Request, Query, Depends, Response
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Request, Query, Depends, Response, HTTPException
+from file_serving import FILE_CACHE, file_response
+from metrics import load_recent_runs, render_prometheus
+from report_jobs import REPORT_JOBS, JobQueueFull, is_finished_week
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, conint
 import os
@@ -18,6 +20,7 @@ class ReportQueryParams(BaseModel):
     week: conint(ge=1, le=52) = Query(..., description="Week number (1-52)")
     year: conint(ge=2024) = Query(..., description="Year (2024 or later)")
     download: bool = Query(False, description="Download the report")
+    retry: bool = Query(False, description="Generate the report again if it failed")
 
 @app.get("/report")
 async def report(request: Request, query_params: ReportQueryParams = Depends()):
@@ -25,15 +28,45 @@ async def report(request: Request, query_params: ReportQueryParams = Depends()):
     year = query_params.year
     download = query_params.download
     if download:
-        return await serve_file(f"Nukainavimai_{year}_{week}_savaite.xlsx")
+        filename = f"Nukainavimai_{year}_{week}_savaite.xlsx"
     else:
-        return await serve_file(f"report_{year}_{week}.html")
+        filename = f"report_{year}_{week}.html"
+
+    path = os.path.join(DATA_FOLDER, filename)
+    if FILE_CACHE.get(path) is None and is_finished_week(year, week):
+        job = REPORT_JOBS.get(year, week)
+        # a job that just finished made the file after it was last checked
+        if job is None or job.status != "done" or FILE_CACHE.refresh(path) is None:
+            # not generated yet: generate it in the background and show the job's progress
+            try:
+                job = REPORT_JOBS.submit(year, week, retry=query_params.retry)
+            except JobQueueFull as e:
+                raise HTTPException(status_code=503, detail=str(e))
+            return templates.TemplateResponse(request, "job.html", {"job": job}, status_code=202)
+    return await serve_file(filename, request)
+
+@app.get("/jobs")
+async def jobs():
+    return REPORT_JOBS.statuses()
+
+@app.get("/jobs/{year}/{week}")
+async def job_status(year: int, week: int):
+    job = REPORT_JOBS.get(year, week)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No report job for this week")
+    return job.to_dict()
+
+@app.get("/metrics")
+async def metrics():
+    # stage timings of the recent script runs, in the Prometheus text format
+    return Response(render_prometheus(load_recent_runs()), media_type="text/plain; version=0.0.4")
 
 @app.get("/files/{filename}")
-async def serve_file(filename: str):
-    if not os.path.exists(os.path.join(DATA_FOLDER, filename)):
-        return "File not found", 404
-    return FileResponse(os.path.join(DATA_FOLDER, filename))
+async def serve_file(filename: str, request: Request):
+    # only files directly in DATA_FOLDER
+    if os.path.basename(filename) != filename or filename.startswith('.'):
+        raise HTTPException(status_code=404, detail="File not found")
+    return file_response(request, os.path.join(DATA_FOLDER, filename))
 
 @app.get("/")
 async def index(request: Request):
@@ -41,6 +74,10 @@ async def index(request: Request):
     current_year = current_date.year
     return templates.TemplateResponse("index.html", {"request": request, "year": current_year})
 
+@app.on_event("shutdown")
+def stop_report_jobs():
+    REPORT_JOBS.shutdown()
+
 # Start FastAPI server
 if __name__ == "__main__":
     uvicorn.run(app = app, host=HOST, port=PORT, ssl_keyfile=SSL_KEYFILE,  ssl_certfile=SSL_CERTFILE)
\ No newline at end of file
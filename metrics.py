@@ -0,0 +1,252 @@
+"""
+Timings and counters of the pipeline stages.
+
+A run (a weekly report, a daily Z report, an outbox delivery) is wrapped in `run(job, **labels)`;
+the code inside times its stages with `stage(name)` (or the `timed(name)` decorator) and counts
+things with `count(name, n)`. When the run ends it is appended as one JSON line to METRICS_FILE.
+`render_prometheus` aggregates the recent runs for the web server's /metrics endpoint.
+Outside a run, stages and counters are not recorded.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from config import METRICS_FILE, METRICS_RECENT_RUNS, METRICS_MAX_BYTES
+
+# The run of the thread that started it, and the process-wide run that threads without
+# their own (e.g. the pools a script starts) record into
+_local = threading.local()
+_process_run = None
+_process_lock = threading.Lock()
+
+
+class Run:
+    """Stage timings and counters of one run, safe to update from several threads."""
+
+    def __init__(self, job: str, labels: dict):
+        self.job = job
+        self.labels = labels
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add_stage(self, name: str, seconds: float, error: bool) -> None:
+        with self.lock:
+            stats = self.stages.setdefault(name, {"calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0})
+            stats["calls"] += 1
+            stats["errors"] += error
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def add_count(self, name: str, n: float) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, error: BaseException = None) -> dict:
+        with self.lock:
+            return {
+                "job": self.job,
+                "labels": self.labels,
+                "started_at": self.started_at,
+                "seconds": time.perf_counter() - self.started,
+                "status": "failed" if error is not None else "ok",
+                "error": f"{type(error).__name__}: {error}" if error is not None else None,
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                "stages": self.stages,
+                "counters": self.counters,
+            }
+
+
+def current_run():
+    """The run stages are recorded into in this thread, or None."""
+    return getattr(_local, "run", None) or _process_run
+
+
+@contextmanager
+def run(job: str, **labels):
+    """
+    Records a run of job (labels such as shop or week go into the record). A run started
+    inside another one in the same thread is part of the outer run.
+    """
+    global _process_run
+    if getattr(_local, "run", None) is not None:
+        yield _local.run
+        return
+    current = Run(job, {key: str(value) for key, value in labels.items() if value is not None})
+    _local.run = current
+    with _process_lock:
+        if _process_run is None:
+            _process_run = current
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _local.run = None
+        with _process_lock:
+            if _process_run is current:
+                _process_run = None
+        save_run(current.record(error))
+
+def reset() -> None:
+    """
+    Forgets the runs a forked worker process inherited from its parent, so the runs it starts
+    are its own and get saved (call it from the pool's initializer).
+    """
+    global _process_run, _process_lock
+    _local.run = None
+    _process_run = None
+    _process_lock = threading.Lock()
+
+
+@contextmanager
+def stage(name: str):
+    """Times the block as a stage of the current run (an exception counts as an error)."""
+    current = current_run()
+    if current is None:
+        yield
+        return
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        current.add_stage(name, time.perf_counter() - started, error)
+
+def timed(name: str):
+    """Decorator: each call of the function is timed as the stage name."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_stage(name: str, seconds: float, error: bool = False) -> None:
+    """Records a stage call timed elsewhere (e.g. summed over many reads) in the current run."""
+    current = current_run()
+    if current is not None:
+        current.add_stage(name, seconds, error)
+
+def count(name: str, n: float = 1) -> None:
+    """Adds n to a counter of the current run."""
+    current = current_run()
+    if current is not None:
+        current.add_count(name, n)
+
+
+def save_run(record: dict) -> None:
+    """
+    Appends the run to METRICS_FILE with a single write, so runs of several processes do not
+    interleave. The file is rotated to METRICS_FILE.1 once it grows past METRICS_MAX_BYTES.
+    """
+    line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+    try:
+        if os.path.exists(METRICS_FILE) and os.path.getsize(METRICS_FILE) > METRICS_MAX_BYTES:
+            os.replace(METRICS_FILE, METRICS_FILE + ".1")
+        fd = os.open(METRICS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        # metrics are never worth failing a run for
+        print(f"Could not save run metrics: {e}")
+
+
+def load_recent_runs(limit: int = METRICS_RECENT_RUNS) -> list:
+    """The last `limit` runs of METRICS_FILE (and its rotated copy, if needed), oldest first."""
+    runs = []
+    for path in (METRICS_FILE, METRICS_FILE + ".1"):
+        if len(runs) >= limit or not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            lines = f.readlines()
+        older = []
+        for line in lines[-(limit - len(runs)):]:
+            try:
+                older.append(json.loads(line))
+            except ValueError:
+                continue  # a line cut short by a crash
+        runs = older + runs
+    return runs
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels: dict) -> str:
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + "}"
+
+
+def render_prometheus(runs: list) -> str:
+    """
+    The runs aggregated per job (and shop) in the Prometheus text format: how many runs ended
+    ok or failed, the last run's time, duration and status, and per stage the call count,
+    errors, total and max seconds, and the counters' totals.
+    """
+    groups = {}
+    for record in runs:
+        key = (record["job"], record.get("labels", {}).get("shop", ""))
+        groups.setdefault(key, []).append(record)
+
+    families = {
+        "reportflow_runs": ("gauge", "Recent runs by status", []),
+        "reportflow_last_run_timestamp_seconds": ("gauge", "When the last run started", []),
+        "reportflow_last_run_duration_seconds": ("gauge", "How long the last run took", []),
+        "reportflow_last_run_success": ("gauge", "Whether the last run ended without an error", []),
+        "reportflow_stage_calls": ("gauge", "Stage calls in the recent runs", []),
+        "reportflow_stage_errors": ("gauge", "Stage calls that raised in the recent runs", []),
+        "reportflow_stage_seconds_sum": ("gauge", "Seconds spent in the stage in the recent runs", []),
+        "reportflow_stage_seconds_max": ("gauge", "Longest stage call in the recent runs", []),
+        "reportflow_counter": ("gauge", "Counter totals of the recent runs", []),
+    }
+    for (job, shop), records in sorted(groups.items()):
+        labels = {"job": job, "shop": shop}
+        for status in ("ok", "failed"):
+            n = sum(1 for record in records if record["status"] == status)
+            families["reportflow_runs"][2].append(({**labels, "status": status}, n))
+        last = records[-1]
+        families["reportflow_last_run_timestamp_seconds"][2].append((labels, last["started_at"]))
+        families["reportflow_last_run_duration_seconds"][2].append((labels, last["seconds"]))
+        families["reportflow_last_run_success"][2].append((labels, int(last["status"] == "ok")))
+
+        stages, counters = {}, {}
+        for record in records:
+            for name, stats in record.get("stages", {}).items():
+                total = stages.setdefault(name, {"calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0})
+                total["calls"] += stats["calls"]
+                total["errors"] += stats["errors"]
+                total["seconds"] += stats["seconds"]
+                total["max_seconds"] = max(total["max_seconds"], stats["max_seconds"])
+            for name, value in record.get("counters", {}).items():
+                counters[name] = counters.get(name, 0) + value
+        for name, total in sorted(stages.items()):
+            stage_labels = {**labels, "stage": name}
+            families["reportflow_stage_calls"][2].append((stage_labels, total["calls"]))
+            families["reportflow_stage_errors"][2].append((stage_labels, total["errors"]))
+            families["reportflow_stage_seconds_sum"][2].append((stage_labels, total["seconds"]))
+            families["reportflow_stage_seconds_max"][2].append((stage_labels, total["max_seconds"]))
+        for name, value in sorted(counters.items()):
+            families["reportflow_counter"][2].append(({**labels, "name": name}, value))
+
+    lines = []
+    for name, (kind, help_text, samples) in families.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
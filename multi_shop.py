@@ -0,0 +1,76 @@
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from config import load_shops
+from b1_api import init_worker
+from supplier_cache import compact_mapping_csv
+
+JOBS = ("daily", "weekly")
+
+
+def run_job(job, shop):
+    """Runs the daily or weekly script for one shop (in a worker process). Returns the seconds it took."""
+    started = time.perf_counter()
+    if job == "daily":
+        from daily_script import main
+        main(shop)
+    else:
+        from weekly_script import reduced_sales_report
+        current_date = datetime.now()
+        reduced_sales_report(year=current_date.year, week_number=current_date.isocalendar()[1], shop=shop)
+    return time.perf_counter() - started
+
+
+def run_shops(job, shops, max_parallel=None):
+    """
+    Runs a job ('daily' or 'weekly') for several shops at once, at most max_parallel at a time
+    (default: one per shop), each in its own process and writing to its own data folder.
+    A shop that fails does not stop the others. Returns the keys of the shops that failed.
+    """
+    started = time.perf_counter()
+    max_parallel = max_parallel or len(shops)
+    print(f"Running the {job} job for {len(shops)} shops, {max_parallel} at a time.")
+
+    failed = []
+    # spawn, as in backfill_script: no locks or sessions of this process are inherited
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_parallel, mp_context=context, initializer=init_worker) as pool:
+        futures = {pool.submit(run_job, job, shop): shop for shop in shops}
+        for future in as_completed(futures):
+            shop = futures[future]
+            try:
+                print(f"{shop.name}: done in {future.result():.1f}s.")
+            except Exception as e:
+                print(f"{shop.name}: failed: {e}")
+                failed.append(shop.key)
+
+    # shops sharing a cache folder share mapping.csv, compact each one once
+    for mapping_csv in sorted({shop.mapping_csv for shop in shops}):
+        if os.path.exists(mapping_csv):
+            compact_mapping_csv(mapping_csv)
+
+    print(f"{job.capitalize()} job done in {time.perf_counter() - started:.1f}s: "
+          f"{len(shops) - len(failed)} shops ok, {len(failed)} failed.")
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the daily or weekly job for several shops (see SHOPS).")
+    parser.add_argument("job", choices=JOBS)
+    parser.add_argument("--shops", default=None, help="comma separated shop keys (default: all shops)")
+    parser.add_argument("--parallel", type=int, default=None, help="shops run at a time (default: all)")
+    args = parser.parse_args()
+
+    shops = load_shops()
+    if args.shops:
+        keys = [key.strip() for key in args.shops.split(",") if key.strip()]
+        unknown = set(keys) - {shop.key for shop in shops}
+        if unknown:
+            parser.error(f"unknown shops: {', '.join(sorted(unknown))}")
+        shops = [shop for shop in shops if shop.key in keys]
+    failed = run_shops(args.job, shops, max_parallel=args.parallel)
+    raise SystemExit(1 if failed else 0)
@@ -1,45 +1,238 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import os
+import queue
+import re
+import time
 import requests
-from bs4 import BeautifulSoup
-from config import LOGIN_URL, FILTER_URL, EXPORT_URL, DOWNLOAD_URL, LOGOUT_URL, USERNAME, PASSWORD
+import urllib3
+import metrics
+from config import POS_SESSION_MAX_AGE_HOURS, EXPORT_COLUMNS_FIELD, ShopConfig, default_shop
+
+# Attempts at a download, resuming after a dropped connection
+DOWNLOAD_ATTEMPTS = 3
+
+# The token input as the POS login page renders it (attributes in either order)
+TOKEN_PATTERNS = [
+    re.compile(r'<input[^>]*name="__RequestVerificationToken"[^>]*value="([^"]*)"'),
+    re.compile(r'<input[^>]*value="([^"]*)"[^>]*name="__RequestVerificationToken"'),
+]
+
+
+def extract_verification_token(html: str) -> str:
+    """Finds __RequestVerificationToken with a regex, parsing the page only if that fails."""
+    for pattern in TOKEN_PATTERNS:
+        match = pattern.search(html)
+        if match:
+            return match.group(1)
+    from bs4 import BeautifulSoup
+    token_input = BeautifulSoup(html, "html.parser").find("input", {"name": "__RequestVerificationToken"})
+    return token_input["value"] if token_input else None
+
+
+def get_expected_size(response: requests.Response) -> int:
+    """Full size of the (uncompressed) file a download response carries, when the server says so."""
+    content_range = response.headers.get("Content-Range", "")
+    if response.status_code == 206 and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        return int(total) if total.isdigit() else None
+    content_length = response.headers.get("Content-Length")
+    if response.headers.get("Content-Encoding", "identity") == "identity" and content_length and content_length.isdigit():
+        return int(content_length)
+    return None
+
+
+class DownloadStream(io.RawIOBase):
+    """
+    Readable body of a download that also saves every byte read to a file, so the export can be
+    parsed while it arrives. The file is written as file_path + '.part' and renamed to file_path
+    when the stream is closed (the rest of the body is saved first).
+    request(offset) makes the download request (see POSClient.request_download). If the connection
+    drops, the download is resumed from the bytes already read, as download_file does, and the
+    final size is checked against what the server announced.
+    """
+
+    def __init__(self, request, file_path: str, max_attempts: int = DOWNLOAD_ATTEMPTS):
+        self.request = request
+        self.max_attempts = max_attempts
+        self.attempt = 1
+        self.file_path = file_path
+        self.part_path = file_path + ".part"
+        # time spent waiting for the body, as opposed to parsing it
+        self.read_seconds = 0.0
+        self.size = 0
+        self.open_response(request(0))
+        self.sink = open(self.part_path, "wb")
+
+    def open_response(self, response: requests.Response) -> None:
+        self.response = response
+        self.response.raw.decode_content = True
+        self.expected_size = get_expected_size(response)
+
+    def readable(self):
+        return True
+
+    def resume(self, reason: str) -> None:
+        """Asks for the rest of the file after a dropped connection or a short body."""
+        print(f"Download interrupted (attempt {self.attempt}/{self.max_attempts}): {reason}")
+        self.response.close()
+        if self.attempt >= self.max_attempts:
+            raise RuntimeError(f"Download failed after {self.max_attempts} attempts.")
+        self.attempt += 1
+        self.open_response(self.request(self.size))
+        if self.response.status_code == 200:
+            # the server sent the whole file again; what was already read is skipped
+            skipped = 0
+            while skipped < self.size:
+                piece = self.response.raw.read(min(65536, self.size - skipped))
+                if not piece:
+                    break
+                skipped += len(piece)
+
+    def read_raw(self, size: int) -> bytes:
+        started = time.perf_counter()
+        try:
+            while True:
+                try:
+                    data = self.response.raw.read(size)
+                except (requests.ConnectionError, urllib3.exceptions.ProtocolError,
+                        urllib3.exceptions.ReadTimeoutError) as e:
+                    self.resume(str(e))
+                    continue
+                if data or self.expected_size is None or self.size >= self.expected_size:
+                    break
+                self.resume(f"received {self.size} bytes, expected {self.expected_size}")
+        finally:
+            self.read_seconds += time.perf_counter() - started
+        self.size += len(data)
+        if self.expected_size is not None and self.size > self.expected_size:
+            raise RuntimeError(f"Downloaded {self.size} bytes, expected {self.expected_size}.")
+        return data
+
+    def readinto(self, buffer):
+        data = self.read_raw(len(buffer))
+        self.sink.write(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            while True:
+                chunk = self.read_raw(65536)
+                if not chunk:
+                    break
+                self.sink.write(chunk)
+            self.sink.close()
+            os.replace(self.part_path, self.file_path)
+            print(f"File downloaded successfully to: {self.file_path}")
+        finally:
+            metrics.record_stage("pos.download", self.read_seconds)
+            metrics.count("pos.download_bytes", self.size)
+            self.sink.close()
+            self.response.close()
+            super().close()
+
+
+class SessionStore:
+    """
+    Keeps the cookies of a logged in POS session on disk, so the next run can reuse the
+    session instead of logging in again. Saved sessions older than max_age_hours are ignored.
+    """
+
+    def __init__(self, path: str, max_age_hours: float = POS_SESSION_MAX_AGE_HOURS):
+        self.path = path
+        self.max_age = max_age_hours * 3600
+
+    def load(self, session: requests.Session) -> bool:
+        """Puts the saved cookies into the session. Returns False if there is no usable saved session."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if time.time() - saved.get("saved_at", 0) > self.max_age:
+            return False
+        for cookie in saved.get("cookies", []):
+            session.cookies.set(cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie["path"])
+        return True
+
+    def save(self, session: requests.Session) -> None:
+        cookies = [
+            {"name": c.name, "value": c.value, "domain": c.domain, "path": c.path}
+            for c in session.cookies
+        ]
+        # the cookies are as good as the password, keep them private
+        fd = os.open(self.path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"saved_at": time.time(), "cookies": cookies}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def get_session_store(slot: int = 0, shop: ShopConfig = None) -> SessionStore:
+    """
+    The session store for a slot of the shop, or None when it has no session file (POS_SESSION_FILE).
+    Sessions used at the same time need different slots, since the server keeps the
+    filter and the pending download per session.
+    """
+    session_file = (shop or default_shop()).pos_session_file
+    if not session_file:
+        return None
+    return SessionStore(session_file if slot == 0 else f"{session_file}.{slot}")
+
+
+def count_response(response, *args, **kwargs):
+    metrics.count("pos.http_requests")
+
 
 class POSClient:
-    def __init__(self, grid: str):
+    def __init__(self, grid: str, session_slot: int = 0, shop: ShopConfig = None):
         """
         :param grid: e.g. 'Transactions', 'ZReports', 'DiscountsApplied', etc. (refering to RASO RETAIL or depending on the POS system)
+        :param session_slot: which saved session to reuse (see get_session_store)
+        :param shop: whose POS system and credentials to use (the default shop if not given)
         """
         self.grid = grid
+        self.shop = shop or default_shop()
         self.session = requests.Session()
+        self.session.hooks["response"].append(count_response)
+        self.session_store = get_session_store(session_slot, self.shop)
 
     @staticmethod # since it does not use self
     def get_error_message(response):
         """Parse a known error message from HTML response."""
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(response.text, "html.parser")
         error_div = soup.find("div", {"class": "dxpc-content"})
         return error_div.text if error_div else "Unknown error"
 
+    @metrics.timed("pos.login")
     def login(self):
         """
         Logs in to the POS system and sets up session cookies.
         Raises an exception if login fails.
         """
-        response = self.session.get(LOGIN_URL.format(GRID=self.grid), verify=False)
-        soup = BeautifulSoup(response.text, "html.parser")
+        response = self.session.get(self.shop.login_url.format(GRID=self.grid), verify=False)
 
-        token_input = soup.find("input", {"name": "__RequestVerificationToken"})
-        if not token_input:
+        token = extract_verification_token(response.text)
+        if not token:
             raise RuntimeError("Could not find RequestVerificationToken on login page.")
 
-        token = token_input["value"]
-
         payload = {
             "__RequestVerificationToken": token,
-            "UserName": USERNAME,
-            "Password": PASSWORD,
+            "UserName": self.shop.username,
+            "Password": self.shop.password,
         }
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
 
         login_response = self.session.post(
-            LOGIN_URL.format(GRID=self.grid),
+            self.shop.login_url.format(GRID=self.grid),
             data=payload, headers=headers, verify=False
         )
 
@@ -48,6 +241,31 @@ class POSClient:
 
         print("Login successful!")
 
+    def is_logged_in(self) -> bool:
+        """
+        Cheap check of the current session: the login page, not following redirects.
+        A logged in session is redirected away from it or is not shown the password field.
+        """
+        response = self.session.get(self.shop.login_url.format(GRID=self.grid), verify=False, allow_redirects=False)
+        if response.is_redirect:
+            return "login" not in response.headers.get("Location", "").lower()
+        return response.status_code == 200 and 'name="Password"' not in response.text
+
+    def ensure_login(self):
+        """
+        Reuses the saved session when there is one and it is still valid, otherwise logs in
+        (and saves the new session when a session store is configured).
+        """
+        if self.session_store and self.session_store.load(self.session):
+            if self.is_logged_in():
+                print("Reusing saved session.")
+                return
+            self.session.cookies.clear()
+        self.login()
+        if self.session_store:
+            self.session_store.save(self.session)
+
+    @metrics.timed("pos.filter")
     def filter_data(self, date_from: str, date_to: str):
         """
         Sends a POST request to filter data for the specified date range.
@@ -55,16 +273,19 @@ class POSClient:
         body = {"dateFrom": date_from, "dateTo": date_to}
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
         response = self.session.post(
-            FILTER_URL.format(GRID=self.grid), data=body, headers=headers, verify=False
+            self.shop.filter_url.format(GRID=self.grid), data=body, headers=headers, verify=False
         )
 
         if response.status_code != 200:
             raise RuntimeError(f"Filter request failed: {response.status_code}")
         print("Filter request successful!")
 
-    def export_data(self, output_format="CSV", grid_name_prefix="GridView"):
+    @metrics.timed("pos.export")
+    def export_data(self, output_format="CSV", grid_name_prefix="GridView", columns=None):
         """
         Triggers the export request (OutputFormat can be CSV, Excel, etc.).
+        columns limits the export to those grid columns when EXPORT_COLUMNS_FIELD is configured
+        (the form field the grid reads its column selection from); otherwise the full grid is exported.
         """
         export_params = {
             "OutputFormat": output_format,
@@ -72,32 +293,137 @@ class POSClient:
             "VID": "undefined",
         }
         body = {}  # In many cases, you might reuse the same body from filter_data
-        response = self.session.post(EXPORT_URL, params=export_params, data=body, verify=False)
+        if columns and EXPORT_COLUMNS_FIELD:
+            body[EXPORT_COLUMNS_FIELD] = ",".join(columns)
+        response = self.session.post(self.shop.export_url, params=export_params, data=body, verify=False)
 
         if response.status_code != 200:
             raise RuntimeError(f"Export request failed: {response.status_code}")
         print("ExportTo request successful!")
 
-    def download_file(self, file_path: str) -> None:
+    @metrics.timed("pos.download")
+    def download_file(self, file_path: str, max_attempts: int = DOWNLOAD_ATTEMPTS) -> None:
         """
         Downloads the exported file and writes it to file_path.
+        The body is asked for compressed. If the connection drops, the download is resumed with a
+        Range request from what was already received (into file_path + '.part'), and the final
+        size is checked against what the server announced before the file is put in place.
         """
-        response = self.session.post(DOWNLOAD_URL, verify=False, stream=True)
-        if response.status_code == 200:
-            print("Download request successful!")
-            with open(file_path, "wb") as file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    file.write(chunk)
-            # .replace('\xa0', '') to clean up the file
+        part_path = file_path + ".part"
+        if os.path.exists(part_path):
+            os.remove(part_path)  # left over from another export
+        for attempt in range(1, max_attempts + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            response = self.request_download(offset)
+            if response.status_code == 200:
+                offset = 0  # the server sent the whole file again
+            expected_size = get_expected_size(response)
+
+            try:
+                with open(part_path, "ab" if offset else "wb") as file:
+                    for chunk in response.iter_content(chunk_size=65536):
+                        file.write(chunk)
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                print(f"Download interrupted (attempt {attempt}/{max_attempts}): {e}")
+                continue
+
+            size = os.path.getsize(part_path)
+            if expected_size is not None and size != expected_size:
+                print(f"Downloaded {size} bytes, expected {expected_size} (attempt {attempt}/{max_attempts}).")
+                if size > expected_size:
+                    os.remove(part_path)
+                continue
+            os.replace(part_path, file_path)
+            metrics.count("pos.download_bytes", size)
             print(f"File downloaded successfully to: {file_path}")
+            return
+        raise RuntimeError(f"Download failed after {max_attempts} attempts.")
+
+    def request_download(self, offset: int = 0) -> requests.Response:
+        """
+        Requests the exported file as a streamed response, compressed, or from offset on to resume
+        a download (uncompressed, as ranges are over the uncompressed file the .part file holds).
+        """
+        if offset:
+            headers = {"Range": f"bytes={offset}-", "Accept-Encoding": "identity"}
         else:
+            headers = {"Accept-Encoding": "gzip, deflate"}
+        response = self.session.post(self.shop.download_url, verify=False, stream=True, headers=headers)
+        if response.status_code not in (200, 206):
             error_msg = self.get_error_message(response)
             raise RuntimeError(f"Download request failed with status {response.status_code}: {error_msg}")
+        print("Download request successful!" if not offset else f"Resuming download at {offset} bytes.")
+        return response
 
+    def download_stream(self, file_path: str, max_attempts: int = DOWNLOAD_ATTEMPTS) -> DownloadStream:
+        """
+        Starts downloading the exported file and returns its body as a binary stream to parse
+        from; the raw bytes are saved to file_path as they are read (see DownloadStream).
+        """
+        return DownloadStream(self.request_download, file_path, max_attempts)
+
+    def fetch_export(self, date_from: str, date_to: str, file_path: str, output_format="CSV", columns=None):
+        """
+        Filters, exports and downloads the grid for a date range over the current (logged in) session.
+        """
+        self.filter_data(date_from, date_to)
+        self.export_data(output_format=output_format, columns=columns)
+        self.download_file(file_path)
+
+    @metrics.timed("pos.logout")
     def logout(self):
         """
         Logs out of the POS system.
+        With a session store the session is kept for the next run instead.
         """
-        log_out_response = self.session.get(LOGOUT_URL, verify=False)
+        if self.session_store:
+            self.session_store.save(self.session)
+            return
+        log_out_response = self.session.get(self.shop.logout_url, verify=False)
         if log_out_response.status_code in [200, 302]:
-            print("Log out successful!")
\ No newline at end of file
+            print("Log out successful!")
+
+
+def run_export(job: dict, session_slot: int = 0, shop: ShopConfig = None) -> str:
+    """Logs in, fetches one export (see export_grids) and logs out again. Returns the file path."""
+    client = POSClient(grid=job["grid"], session_slot=session_slot, shop=shop)
+    client.ensure_login()
+    try:
+        client.fetch_export(
+            job["date_from"], job["date_to"], job["file_path"],
+            output_format=job.get("output_format", "CSV"), columns=job.get("columns")
+        )
+    finally:
+        client.logout()
+    return job["file_path"]
+
+
+def export_grids(jobs: dict, max_workers: int = 3, shop: ShopConfig = None) -> dict:
+    """
+    Runs several exports concurrently, so the waits for the server to build them overlap.
+    jobs maps a name to a dict with 'grid', 'date_from', 'date_to', 'file_path' (and optionally
+    'output_format' and 'columns'); the same grid can appear with different date windows.
+    Each export gets its own session, since the filter and the download are per session on the server.
+    Returns name -> file path, or name -> the exception if that export failed.
+    """
+    free_slots = queue.Queue()
+    for slot in range(max_workers):
+        free_slots.put(slot)
+
+    def run(job):
+        slot = free_slots.get()
+        try:
+            return run_export(job, session_slot=slot, shop=shop)
+        finally:
+            free_slots.put(slot)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {name: executor.submit(run, job) for name, job in jobs.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                print(f"Export {name} failed: {e}")
+                results[name] = e
+    return results
@@ -1,8 +1,44 @@
-from config import PREFIX_SUPPLIER_MAP
+import pandas as pd
+from config import default_shop
 
-def get_supplier_by_prefix(product_code_str: str) -> str:
-    """Get the supplier name by product code prefix."""
-    for prefix, supplier_name in PREFIX_SUPPLIER_MAP.items():
-        if product_code_str.startswith(prefix):
+# id(prefix map) -> (prefix map, its index); the map is kept so its id is not reused
+_prefix_indexes = {}
+
+def build_prefix_index(prefix_map: dict) -> list:
+    """
+    Groups the prefixes by length, longest first, so that a lookup only needs one
+    dict access per distinct prefix length and the most specific prefix wins.
+    """
+    by_length = {}
+    for prefix, supplier_name in prefix_map.items():
+        by_length.setdefault(len(prefix), {})[prefix] = supplier_name
+    return sorted(by_length.items(), reverse=True)
+
+def get_prefix_index(prefix_map: dict = None) -> list:
+    """The index of a prefix map (the default shop's PREFIX_SUPPLIER_MAP if not given), built once per map."""
+    if prefix_map is None:
+        prefix_map = default_shop().prefix_supplier_map
+    entry = _prefix_indexes.get(id(prefix_map))
+    if entry is None:
+        entry = _prefix_indexes[id(prefix_map)] = (prefix_map, build_prefix_index(prefix_map))
+    return entry[1]
+
+def get_supplier_by_prefix(product_code_str: str, prefix_map: dict = None) -> str:
+    """Get the supplier name by the longest matching product code prefix."""
+    for length, prefixes in get_prefix_index(prefix_map):
+        supplier_name = prefixes.get(product_code_str[:length])
+        if supplier_name is not None:
             return supplier_name
-    return None
\ No newline at end of file
+    return None
+
+def get_suppliers_by_prefix(codes: pd.Series, prefix_map: dict = None) -> pd.Series:
+    """Get the supplier names for a whole column of product codes (None where no prefix matches)."""
+    codes = codes.astype(str)
+    suppliers = pd.Series(None, index=codes.index, dtype=object)
+    for length, prefixes in get_prefix_index(prefix_map):
+        missing = suppliers.isna()
+        if not missing.any():
+            break
+        suppliers[missing] = codes[missing].str[:length].map(prefixes)
+    # map leaves NaN where no prefix matched
+    return suppliers.where(suppliers.notna(), None)
@@ -0,0 +1,160 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, timedelta
+
+from config import REPORT_JOB_WORKERS, REPORT_JOB_MAX_PENDING, REPORT_JOB_RETRY_SECONDS
+
+# POS session slots of the workers start here, so a job never shares a session
+# with weekly_script (slot 0) or backfill_script (slots 0..)
+SESSION_SLOT_OFFSET = 10
+# Finished jobs kept for the status endpoint
+MAX_FINISHED_JOBS = 100
+
+# Session slot of this worker process
+worker_session_slot = 0
+
+
+def init_worker(slots) -> None:
+    global worker_session_slot
+    worker_session_slot = slots.get()
+    from b1_api import init_worker as init_report_worker
+    init_report_worker()
+
+def run_report(year: int, week_number: int) -> float:
+    """Builds one week's reports in a worker process, without publishing or emailing them."""
+    from weekly_script import reduced_sales_report
+    started = time.perf_counter()
+    reduced_sales_report(year, week_number, reprocess=True, session_slot=worker_session_slot)
+    return time.perf_counter() - started
+
+
+def is_finished_week(year: int, week_number: int) -> bool:
+    """
+    Whether the week (as weekly_script.get_week_interval counts them) ended before today. A week
+    in progress would be downloaded half-way, and the weekly script then skips it as done.
+    """
+    first_day = date(year, 1, 1)
+    end_of_week = first_day + timedelta(days=(week_number - 1) * 7 - first_day.weekday() + 6)
+    return end_of_week < date.today()
+
+
+class JobQueueFull(Exception):
+    """Raised when too many report jobs are already waiting."""
+
+
+class ReportJob:
+    """One on-demand report generation for a week."""
+
+    def __init__(self, year: int, week_number: int):
+        self.year = year
+        self.week_number = week_number
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.duration = None
+        self.error = None
+        self.future = None
+
+    @property
+    def status(self) -> str:
+        if self.future is None or not self.future.done():
+            return "running" if self.future is not None and self.future.running() else "queued"
+        return "failed" if self.future.cancelled() or self.future.exception() is not None else "done"
+
+    def finish(self, future) -> None:
+        self.finished_at = time.time()
+        try:
+            self.duration = future.result()
+        except BaseException as e:
+            self.error = f"{type(e).__name__}: {e}"
+
+    def to_dict(self) -> dict:
+        return {
+            "year": self.year,
+            "week": self.week_number,
+            "status": self.status,
+            "submitted_at": self.submitted_at,
+            "finished_at": self.finished_at,
+            "duration": self.duration,
+            "error": self.error,
+        }
+
+
+class ReportJobs:
+    """
+    Runs reduced_sales_report for requested weeks in a pool of worker processes, so the web
+    server's event loop is never blocked. Requests for a week that is already queued or running
+    get that job instead of a new one, and so do requests for a week whose job failed less than
+    retry_seconds ago (unless retry is set), so a failing week is not tried again on every reload. At most max_workers jobs run at a time and at most
+    max_pending wait; the pool is started on the first job.
+    """
+
+    def __init__(self, max_workers: int = REPORT_JOB_WORKERS, max_pending: int = REPORT_JOB_MAX_PENDING,
+                 retry_seconds: float = REPORT_JOB_RETRY_SECONDS):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retry_seconds = retry_seconds
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            # spawn: forking the web server's threads and event loop is not safe
+            context = multiprocessing.get_context("spawn")
+            slots = context.Queue()
+            for slot in range(self.max_workers):
+                slots.put(SESSION_SLOT_OFFSET + slot)
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=context,
+                initializer=init_worker, initargs=(slots,),
+            )
+        return self.executor
+
+    def get(self, year: int, week_number: int):
+        return self.jobs.get((year, week_number))
+
+    def statuses(self) -> list:
+        return [job.to_dict() for job in self.jobs.values()]
+
+    def submit(self, year: int, week_number: int, retry: bool = False) -> ReportJob:
+        """Starts a job for the week, or returns the one already queued or running (or recently failed)."""
+        key = (year, week_number)
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is not None and job.status in ("queued", "running"):
+                return job
+            if job is not None and job.status == "failed" and not retry and \
+                    time.time() - (job.finished_at or job.submitted_at) < self.retry_seconds:
+                return job
+            pending = sum(1 for job in self.jobs.values() if job.status in ("queued", "running"))
+            if pending >= self.max_pending + self.max_workers:
+                raise JobQueueFull(f"{pending} report jobs are already waiting")
+
+            job = ReportJob(year, week_number)
+            try:
+                job.future = self.get_executor().submit(run_report, year, week_number)
+            except BrokenProcessPool:
+                # a worker died (e.g. out of memory); start a new pool
+                self.executor = None
+                job.future = self.get_executor().submit(run_report, year, week_number)
+            job.future.add_done_callback(job.finish)
+            self.jobs.pop(key, None)
+            self.jobs[key] = job
+            self.prune()
+            print(f"Report job for week {week_number} of {year} submitted.")
+            return job
+
+    def prune(self) -> None:
+        finished = [key for key, job in self.jobs.items() if job.status in ("done", "failed")]
+        for key in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[key]
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+REPORT_JOBS = ReportJobs()
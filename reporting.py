@@ -1,9 +1,56 @@
+import gzip
 import os
+import shutil
+import numpy as np
 import pandas as pd
 from datetime import datetime
+from jinja2 import Environment, FileSystemLoader
+import metrics
 from config import SHOP_NAME
 
-def generate_html_report(
+TEMPLATES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+environment = Environment(
+    loader=FileSystemLoader(TEMPLATES_FOLDER),
+    autoescape=True,
+    trim_blocks=True,
+    lstrip_blocks=True,
+)
+# Rendered text is encoded and written out in pieces of about this size
+WRITE_BUFFER_SIZE = 64 * 1024
+# Compressed copies written next to a report, by suffix
+COMPRESSED_SUFFIXES = ['.gz', '.br']
+
+
+def format_value(value) -> str:
+    """Cell text: floats with two decimals, missing values empty."""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ""
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value)
+
+def iter_rows(df: pd.DataFrame):
+    """Yields the rows of a DataFrame as lists of cell texts."""
+    for row in df.itertuples(index=False, name=None):
+        yield [format_value(value) for value in row]
+
+def iter_supplier_sections(products_df: pd.DataFrame):
+    """Yields one section per supplier: its name, product count, discount total and rows (without 'Tiekėjas')."""
+    products_df = products_df.sort_values('Tiekėjas', kind='stable')
+    suppliers = products_df['Tiekėjas'].astype(str).to_numpy()
+    starts = np.flatnonzero(np.r_[True, suppliers[1:] != suppliers[:-1]]) if len(suppliers) else []
+    ends = np.r_[starts[1:], len(suppliers)] if len(suppliers) else []
+    rows_df = products_df.drop(columns='Tiekėjas')
+    for start, end in zip(starts, ends):
+        section_df = rows_df.iloc[start:end]
+        yield {
+            'supplier': suppliers[start],
+            'count': end - start,
+            'discount': format_value(float(section_df['Nuol.'].sum())),
+            'rows': iter_rows(section_df),
+        }
+
+def render_html_report(
     products_df: pd.DataFrame,
     grouped_df: pd.DataFrame,
     missing_values_df: pd.DataFrame,
@@ -11,49 +58,129 @@ def generate_html_report(
     start_date,
     end_date,
     week_number: int,
-    year: int
-) -> str:
+    year: int,
+    shop_name: str = SHOP_NAME
+):
+    """
+    Renders templates/report.html piece by piece: returns a generator of HTML strings,
+    so rows are formatted only as they are written out.
+    """
+    missing_codes = ""
+    if not missing_values_df.empty:
+        missing_codes = ", ".join(missing_values_df['Prekės kodas'].astype(str).unique())
+    file_time = datetime.fromtimestamp(os.path.getmtime(file_downloaded)).strftime('%Y-%m-%d %H:%M:%S')
+
+    template = environment.get_template("report.html")
+    return template.generate(
+        shop_name=shop_name,
+        start_date=start_date,
+        end_date=end_date,
+        week_number=week_number,
+        year=year,
+        product_columns=[column for column in products_df.columns if column != 'Tiekėjas'],
+        sections=iter_supplier_sections(products_df),
+        grouped_columns=list(grouped_df.columns),
+        grouped_rows=iter_rows(grouped_df),
+        missing_codes=missing_codes,
+        file_time=file_time,
+    )
+
+def generate_html_report(*args, **kwargs) -> str:
     """
     Generates an HTML report string that you can save to a file.
+    Takes the arguments of render_html_report; write_html_report writes it out without building the string.
     """
-    html_str = []
-    html_str.append("<html><head><title>Nukainavimai {}</title>".format(week_number))
-    html_str.append('<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bulma@0.9.4/css/bulma.min.css">')
-    html_str.append("</head><body>")
+    return "".join(render_html_report(*args, **kwargs))
 
-    # Some styling
-    html_str.append("<style>.table thead th {padding: 6px 4px;} .table tbody td { padding: 2px 4px;}</style>")
 
-    # Header
-    html_str.append(f"""
-    <div class="columns">
-      <div class="column"><h1 class="is-3 title">Nukainavimai {week_number} savaitė</h1></div>
-      <div class="column"><div class="has-text-right">{SHOP_NAME} <br> Periodas: {start_date} - {end_date}</div></div>
-    </div>
-    """)
+class ReportFiles:
+    """Writes the report and its compressed copies at once; each file only appears under its name once complete."""
 
-    # Main table
-    html_str.append(products_df.to_html(index=False, classes='main-table table is-striped is-hoverable'))
+    def __init__(self, output_path: str):
+        self.paths = [output_path]
+        self.files = [open(output_path + '.tmp', 'wb')]
+        self.files.append(gzip.open(output_path + '.gz.tmp', 'wb', compresslevel=6))
+        self.paths.append(output_path + '.gz')
+        try:
+            import brotli
+        except ImportError:
+            self.brotli = None
+        else:
+            self.brotli = brotli.Compressor(mode=brotli.MODE_TEXT, quality=9)
+            self.brotli_file = open(output_path + '.br.tmp', 'wb')
+            self.paths.append(output_path + '.br')
 
-    # Grouped sums
-    html_str.append("<div class='columns'>")
-    html_str.append("<div class='column'>")
-    html_str.append("<h1>Suvestinė pagal tiekėją</h1>")
-    # add  page-break-inside: avoid; to the style attribute of the table tag
-    html_str.append(grouped_df.to_html(index=False, classes='table avoid-page-break-inside is-striped is-hoverable'))
+    def write(self, data: bytes) -> None:
+        for f in self.files:
+            f.write(data)
+        if self.brotli is not None:
+            self.brotli_file.write(self.brotli.process(data))
 
-    html_str.append("</div>")
+    def close(self) -> None:
+        if self.brotli is not None:
+            self.brotli_file.write(self.brotli.finish())
+            self.brotli_file.close()
+        for f in self.files:
+            f.close()
+        for path in self.paths:
+            os.replace(path + '.tmp', path)
 
-    # Missing values, file info, etc.
-    html_str.append("<div class='column has-text-info'>")
-    if not missing_values_df.empty:
-        missing_values_str = ", ".join(missing_values_df['Prekės kodas'].astype(str).unique())
-        html_str.append(f"<p>Nepavyko surasti tiekėjų šiems kodams: {missing_values_str}</p>")
+    def abort(self) -> None:
+        if self.brotli is not None:
+            self.brotli_file.close()
+        for f in self.files:
+            f.close()
+        for path in self.paths:
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
 
-    file_time = datetime.fromtimestamp(os.path.getmtime(file_downloaded)).strftime('%Y-%m-%d %H:%M:%S')
-    html_str.append(f"<p>Ataskaita sugeruota: {file_time}</p>")
-    html_str.append("</div></div>")
 
-    html_str.append("</body></html>")
+@metrics.timed("report.html")
+def write_html_report(output_path: str, **report_kwargs) -> list:
+    """
+    Streams the report (see render_html_report) into output_path, with .gz and, when brotli
+    is installed, .br copies written in the same pass. Returns the paths written.
+    """
+    files = ReportFiles(output_path)
+    try:
+        buffer, size = [], 0
+        for piece in render_html_report(**report_kwargs):
+            buffer.append(piece)
+            size += len(piece)
+            if size >= WRITE_BUFFER_SIZE:
+                files.write("".join(buffer).encode('utf-8'))
+                buffer, size = [], 0
+        files.write("".join(buffer).encode('utf-8'))
+    except BaseException:
+        files.abort()
+        raise
+    files.close()
+    # a copy left over from a run with brotli installed would be stale now
+    for suffix in COMPRESSED_SUFFIXES:
+        if output_path + suffix not in files.paths and os.path.exists(output_path + suffix):
+            os.remove(output_path + suffix)
+    return files.paths
+
+def report_variants(path: str) -> list:
+    """The report and its compressed copies."""
+    return [path] + [path + suffix for suffix in COMPRESSED_SUFFIXES]
 
-    return "\n".join(html_str)
\ No newline at end of file
+@metrics.timed("report.publish")
+def publish_report(report_path: str, published_path: str) -> None:
+    """
+    Makes published_path (and its compressed copies) the same file as report_path, replacing it
+    atomically. A hardlink is used where possible, a copy otherwise (e.g. across filesystems).
+    """
+    for source, target in zip(report_variants(report_path), report_variants(published_path)):
+        if not os.path.exists(source):
+            if os.path.exists(target):
+                os.remove(target)
+            continue
+        tmp_path = target + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
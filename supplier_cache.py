@@ -0,0 +1,159 @@
+import csv
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+MAPPING_HEADER = ["Prekės kodas", "Tiekėjas"]
+
+
+def append_mapping_rows(mapping_csv: str, rows: list) -> None:
+    """Appends (barcode, supplier) rows to the mapping CSV in one write."""
+    if not rows:
+        return
+    new_file = not os.path.exists(mapping_csv) or os.path.getsize(mapping_csv) == 0
+    needs_newline = False
+    if not new_file:
+        # make sure we start on a fresh line
+        with open(mapping_csv, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+    with open(mapping_csv, "a", encoding="utf-8", newline="") as f:
+        if needs_newline:
+            f.write("\n")
+        writer = csv.writer(f, lineterminator="\n")
+        if new_file:
+            writer.writerow(MAPPING_HEADER)
+        writer.writerows(rows)
+
+
+def compact_mapping_csv(mapping_csv: str) -> int:
+    """
+    Rewrites the mapping CSV without duplicate product codes (the first row wins,
+    same as map_suppliers) and without blank lines. Returns the number of rows dropped.
+    A file that is already clean is left untouched.
+    """
+    if not os.path.exists(mapping_csv):
+        return 0
+    with open(mapping_csv, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, MAPPING_HEADER)
+        seen = set()
+        rows = []
+        dropped = 0
+        blank = 0
+        for row in reader:
+            if not row or not row[0].strip():
+                blank += 1
+                continue
+            code = row[0].strip()
+            if code in seen:
+                dropped += 1
+                continue
+            seen.add(code)
+            rows.append(row)
+    if not dropped and not blank:
+        return 0
+
+    tmp_path = mapping_csv + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(tmp_path, mapping_csv)
+    return dropped
+
+
+class SupplierCache:
+    """
+    Barcode -> supplier cache that survives between runs.
+    Both hits and misses (supplier None) are stored in SQLite with the time they were
+    checked; misses expire after miss_ttl_days so that new items in B1 get picked up.
+    Lookups are served from an in-memory dict loaded once, writes are batched.
+    """
+
+    def __init__(self, db_path: str, mapping_csv: str = None, miss_ttl_days: float = 30,
+                 compact_every_days: float = 7, batch_size: int = 100):
+        self.db_path = db_path
+        self.mapping_csv = mapping_csv
+        self.miss_ttl = miss_ttl_days * 86400
+        self.compact_every = compact_every_days * 86400
+        self.batch_size = batch_size
+        self._entries = None  # barcode -> (supplier, checked_at)
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS suppliers ("
+            "barcode TEXT PRIMARY KEY, supplier TEXT, checked_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        return conn
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT barcode, supplier, checked_at FROM suppliers").fetchall()
+        self._entries = {barcode: (supplier, checked_at) for barcode, supplier, checked_at in rows}
+
+    def lookup(self, barcode: str):
+        """Returns (found, supplier). Expired misses count as not found."""
+        with self._lock:
+            self._load()
+            entry = self._entries.get(barcode)
+        if entry is None:
+            return False, None
+        supplier, checked_at = entry
+        if supplier is None and time.time() - checked_at > self.miss_ttl:
+            return False, None
+        return True, supplier
+
+    def store(self, barcode: str, supplier: str = None) -> None:
+        """Remembers a hit (or a miss when supplier is None)."""
+        self.store_many({barcode: supplier})
+
+    def store_many(self, results: dict) -> None:
+        """Remembers several lookups at once, flushing when the batch is full."""
+        now = time.time()
+        with self._lock:
+            self._load()
+            for barcode, supplier in results.items():
+                self._entries[barcode] = (supplier, now)
+                self._pending[barcode] = (supplier, now)
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self) -> None:
+        """Writes pending entries to SQLite (and new hits to the mapping CSV)."""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            now = time.time()
+            with closing(self._connect()) as conn, conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO suppliers (barcode, supplier, checked_at) VALUES (?, ?, ?)",
+                    [(barcode, supplier, checked_at) for barcode, (supplier, checked_at) in pending.items()],
+                )
+                conn.execute(
+                    "DELETE FROM suppliers WHERE supplier IS NULL AND checked_at < ?",
+                    (now - self.miss_ttl,),
+                )
+                row = conn.execute("SELECT value FROM meta WHERE key = 'mapping_compacted_at'").fetchone()
+                compact = row is None or now - float(row[0]) > self.compact_every
+                if self.mapping_csv and compact:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO meta (key, value) VALUES ('mapping_compacted_at', ?)",
+                        (str(now),),
+                    )
+
+            if self.mapping_csv:
+                hits = [(barcode, supplier) for barcode, (supplier, _) in pending.items() if supplier]
+                append_mapping_rows(self.mapping_csv, hits)
+                if compact:
+                    dropped = compact_mapping_csv(self.mapping_csv)
+                    print(f"Compacted {self.mapping_csv}, dropped {dropped} duplicate rows.")
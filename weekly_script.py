@@ -1,19 +1,32 @@
+import argparse
 import os
 from datetime import datetime, timedelta
 import pandas as pd
 
+import metrics
 from pos_client import POSClient
-from config import DATA_FOLDER, REPORTING_EMAIL
+from config import SALES_EXTRA_FORMATS, default_shop
 from data_processing import (
-    read_csv_windows1257,
-    filter_discounted_sales,
-    map_suppliers,
+    TRANSACTION_COLUMNS,
+    TRANSACTIONS_SCHEMA,
+    TRANSACTIONS_DATE_COLUMNS,
+    iter_export_chunks,
+    prepare_sales,
+    clean_supplier_names,
     summarize_discounts_by_supplier,
+    aggregate_products,
     save_excel
 )
-from reporting import generate_html_report
+from ingestion import load_partitions
+from reporting import write_html_report, publish_report, report_variants
 from email_service import send_email_html
 
+# Rows parsed at a time; only discounted rows are kept from each chunk
+CSV_CHUNK_ROWS = 100_000
+# How the Transactions export is parsed
+READ_OPTIONS = dict(columns=TRANSACTION_COLUMNS, chunksize=CSV_CHUNK_ROWS,
+                    dtype=TRANSACTIONS_SCHEMA, parse_dates=TRANSACTIONS_DATE_COLUMNS)
+
 
 def get_week_interval(year, week_number):
     """Get the start and end date of a week by its number."""
@@ -24,134 +37,175 @@ def get_week_interval(year, week_number):
     return start_of_week.date(), end_of_week.date()
 
 
-def reduced_sales_report(year, week_number):
-    """Generates a report for a given week number and year."""
-    GRID = 'Transactions'
-    pos_client = POSClient(grid=GRID)
-    start_date, end_date = get_week_interval(year, week_number)
-    last_report_path = os.path.join(DATA_FOLDER, "last_report.html")
-    print(f"Week {week_number} of {year}: {start_date} to {end_date}")
-
-    # File name
-    file_name = f"sales_{year}_{week_number}.csv"
-    file_path = os.path.join(DATA_FOLDER, file_name)
-
-    if os.path.exists(file_path):
-        print(f"File {file_name} already exists, skipping generation.")
-        return
-    else:
-        if os.path.exists(last_report_path):
-            os.remove(last_report_path)
+def get_week_paths(year, week_number, shop=None):
+    """Paths of a week's export and of the reports made from it, in the shop's data folder."""
+    data_folder = (shop or default_shop()).data_folder
+    return {
+        'export': os.path.join(data_folder, f"sales_{year}_{week_number}.csv"),
+        'excel': os.path.join(data_folder, f"Nukainavimai_{year}_{week_number}_savaite.xlsx"),
+        'html': os.path.join(data_folder, f"report_{year}_{week_number}.html"),
+    }
 
-    # 1. Login
-    pos_client.login()
 
+def request_week_export(pos_client, start_date, end_date):
+    """Filters and exports the week's Transactions over a logged in POS session."""
     # 2. Filter data
     begin = start_date.strftime('%Y-%m-%d 00:00')
     end = (end_date + timedelta(days=1)).strftime('%Y-%m-%d 00:00')
     pos_client.filter_data(begin, end)
 
     # 3. Export
-    pos_client.export_data(output_format="CSV", grid_name_prefix="GridView")
+    pos_client.export_data(output_format="CSV", grid_name_prefix="GridView", columns=TRANSACTION_COLUMNS)
+
+
+def download_week_export(pos_client, start_date, end_date, file_path):
+    """Exports and downloads the week's Transactions over a logged in POS session."""
+    request_week_export(pos_client, start_date, end_date)
 
     # 4. Download
     pos_client.download_file(file_path)
 
-    # 5. Logout
-    pos_client.logout()
 
-    # 6. Data processing
+def load_week_export(start_date, end_date, file_path, session_slot=0, shop=None):
+    """
+    Downloads the week's Transactions export (unless it is already there) and prepares the sales.
+    session_slot selects the saved POS session to use (see pos_client.get_session_store).
+    """
+    shop = shop or default_shop()
+    mapping_csv = shop.mapping_csv
+    if os.path.exists(file_path):
+        # 6. Data processing, from the Feather sidecar when there is one
+        chunks = iter_export_chunks(file_path, **READ_OPTIONS)
+        return prepare_sales(chunks, mapping_csv=mapping_csv, shop=shop)
 
-    df = read_csv_windows1257(file_path, sep=';')
-    df = filter_discounted_sales(df)
+    pos_client = POSClient(grid='Transactions', session_slot=session_slot, shop=shop)
 
-    df = df.rename(columns={'Nuol. suma 1': 'Nuolaida'})
-    df['Prekės kodas'] = df['Prekės kodas'].astype(int)
+    # 1. Login
+    pos_client.ensure_login()
 
-    df = map_suppliers(df, mapping_csv=os.path.join(DATA_FOLDER, "mapping.csv"))
+    request_week_export(pos_client, start_date, end_date)
 
-    keep_columns = [
-        'Darb. vardas', 'Čekio nr.', 'Prekės kodas', 'Tiekėjas', 'Prekės pavadinimas',
-        'Kiekis', 'Pagr. kaina', 'Pagr. suma', 'Suma', 'Mok. suma', 'Nuolaida', 'Įrašo data'
-    ]
-    df = df[keep_columns]
+    # 4. Download and 6. Data processing: the export is parsed as it arrives,
+    # while its raw bytes are saved to file_path and the sidecar is written
+    with pos_client.download_stream(file_path) as stream:
+        chunks = iter_export_chunks(file_path, source=stream, **READ_OPTIONS)
+        df = prepare_sales(chunks, mapping_csv=mapping_csv, shop=shop)
 
-    # Summaries
-    grouped_df = summarize_discounts_by_supplier(df)
+    # 5. Logout
+    pos_client.logout()
+    return df
 
-    # Export to Excel
-    final_name = f"Nukainavimai_{year}_{week_number}_savaite.xlsx"
-    final_output_path = os.path.join(DATA_FOLDER, final_name)
-    save_excel(df, grouped_df, final_output_path)
-    print(f"Final data exported to {final_output_path}")
 
-    # Generate HTML report
+def build_report_tables(df):
+    """
+    Prepares the sales for the HTML report: one row per supplier and product (with cleaned
+    supplier names) and the rows whose supplier is unknown. Adds a 'Prekė' column to df.
+    """
     # Additional formatting
-    df['Prekė'] = df['Prekės pavadinimas'] + \
+    # names are categorical; astype(str) converts each category once
+    df['Prekė'] = df['Prekės pavadinimas'].astype(str) + \
         ' (' + df['Prekės kodas'].astype(str) + ')'
     df['Įrašo data'] = pd.to_datetime(df['Įrašo data'])
 
     df = df.sort_values(by=['Tiekėjas', 'Suma'], ascending=[True, False])
 
-    df['Tiekėjas'] = (
-        df['Tiekėjas']
-        .str.replace('UAB ', '', regex=False)
-        .str.replace('AB ', '', regex=False)
-        .str.replace('"', '', regex=False)
-        .str.title()
-    )
+    df['Tiekėjas'] = clean_supplier_names(df['Tiekėjas'])
 
-    df['Employee_Date'] = df['Darb. vardas'] + \
+    df['Employee_Date'] = df['Darb. vardas'].astype(str) + \
         ', ' + df['Įrašo data'].dt.strftime('%m-%d')
-    df['Kvitai'] = df.groupby(['Employee_Date', 'Prekė'])['Čekio nr.'].transform(
-        lambda x: ', '.join(x.astype(str).unique())
-    )
-    df['Kvitai'] = df['Kvitai'] + ' (' + df['Employee_Date'] + ')'
-
-    products_df = (
-        df.groupby(['Tiekėjas', 'Prekė'])
-          .agg({
-              'Pagr. kaina': 'mean',
-              'Kiekis': 'sum',
-              'Nuolaida': 'sum',
-              'Kvitai': lambda x: '; '.join(x.unique())
-          })
-        .reset_index()
-    )
-    products_df = products_df.rename(
-        columns={'Nuolaida': 'Nuol.', 'Pagr. kaina': 'Kaina'})
+    products_df = aggregate_products(df)
     missing_values = df[df['Tiekėjas'] == 'Nežinomas']
+    return products_df, missing_values
+
+
+def reduced_sales_report(year, week_number, reprocess=False, incremental=False, session_slot=0, shop=None):
+    """
+    Generates a report for a given week number and year, for the shop (the default shop if not given).
+    With reprocess, a week that was already downloaded is processed again from the saved
+    export (its sidecar) instead of being skipped; last_report.html and the email are left alone.
+    With incremental, the week is put together from the daily partitions (see ingestion.py)
+    instead of one export of the whole week. session_slot is passed on to load_week_export.
+    """
+    shop = shop or default_shop()
+    start_date, end_date = get_week_interval(year, week_number)
+    last_report_path = os.path.join(shop.data_folder, "last_report.html")
+    paths = get_week_paths(year, week_number, shop)
+    html_output_path = paths['html']
+    print(f"Week {week_number} of {year}: {start_date} to {end_date}")
+    if incremental and start_date > datetime.today().date():
+        # no partitions yet; last_report.html is left alone too
+        print(f"Week {week_number} of {year} has not started yet, nothing to report.")
+        return
 
-    html_report = generate_html_report(
-        products_df=products_df,
-        grouped_df=grouped_df,
-        missing_values_df=missing_values,
-        file_downloaded=file_path,
-        start_date=start_date,
-        end_date=end_date,
-        week_number=week_number,
-        year=year
-    )
-    html_output_path = os.path.join(
-        DATA_FOLDER, f"report_{year}_{week_number}.html")
-    with open(html_output_path, "w", encoding="utf-8") as f:
-        f.write(html_report)
-    print(f"HTML report exported")
-
-    # Duplicate last report
-    os.system(f"cp {html_output_path} {last_report_path}")
-
-    # send email
-    message = f"<div style='color: grey;'>Prisegamas {final_name} failas. Tai automatinė žinutė. (This is an automated email.)</div>"
-    send_email_html(
-        subject=f"Nukainavimų ataskaita, {week_number} savaitė",
-        html_content= message + grouped_df.to_html(),
-        attachments=[final_output_path],
-        to_email= REPORTING_EMAIL
-    )
+    # File name
+    file_path = paths['export']
+
+    # a week counts as done once its export was downloaded (its report, for partitions)
+    done_path = html_output_path if incremental else file_path
+    if os.path.exists(done_path) and not reprocess:
+        print(f"File {os.path.basename(done_path)} already exists, skipping generation.")
+        return
+    elif not reprocess:
+        for path in report_variants(last_report_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    with metrics.run("weekly", shop=shop.key, year=year, week=week_number):
+        if incremental:
+            df, file_path = load_partitions(start_date, end_date, shop=shop)
+        else:
+            df = load_week_export(start_date, end_date, file_path, session_slot=session_slot, shop=shop)
+
+        # Summaries
+        grouped_df = summarize_discounts_by_supplier(df)
+
+        # Export to Excel
+        final_output_path = paths['excel']
+        final_name = os.path.basename(final_output_path)
+        save_excel(df, grouped_df, final_output_path, extra_formats=SALES_EXTRA_FORMATS)
+        print(f"Final data exported to {final_output_path}")
+
+        # Generate HTML report
+        products_df, missing_values = build_report_tables(df)
+
+        write_html_report(
+            html_output_path,
+            products_df=products_df,
+            grouped_df=grouped_df,
+            missing_values_df=missing_values,
+            file_downloaded=file_path,
+            start_date=start_date,
+            end_date=end_date,
+            week_number=week_number,
+            year=year,
+            shop_name=shop.name
+        )
+        print(f"HTML report exported")
+
+        if reprocess:
+            return
+
+        # Duplicate last report
+        publish_report(html_output_path, last_report_path)
+
+        # send email
+        message = f"<div style='color: grey;'>Prisegamas {final_name} failas. Tai automatinė žinutė. (This is an automated email.)</div>"
+        subject = f"Nukainavimų ataskaita, {week_number} savaitė"
+        if not shop.is_default:
+            subject += f" ({shop.name})"
+        send_email_html(
+            subject=subject,
+            html_content= message + grouped_df.to_html(),
+            attachments=[final_output_path],
+            to_email= shop.reporting_email
+        )
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Weekly discounts report for the current week.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="build the week from the daily partitions (see ingestion.py)")
+    args = parser.parse_args()
     current_date = datetime.now()
     current_week_number = current_date.isocalendar()[1]
     current_year = current_date.year
-    reduced_sales_report(year=current_year, week_number=current_week_number)
+    reduced_sales_report(year=current_year, week_number=current_week_number, incremental=args.incremental)
@@ -0,0 +1,28 @@
+import csv
+
+
+def parse_value(cell: str):
+    """Converts a Z report cell the way pandas would: empty -> None, then int, then decimal-comma float."""
+    cell = cell.strip()
+    if not cell:
+        return None
+    try:
+        return int(cell)
+    except ValueError:
+        pass
+    try:
+        return float(cell.replace(',', '.'))
+    except ValueError:
+        return cell
+
+
+def read_zreport(file_path: str, sep=';'):
+    """
+    Reads a Z report export (Windows-1257, NBSP thousand separators) with the csv module,
+    so the daily script does not need pandas. Returns the header and the parsed rows.
+    """
+    with open(file_path, 'r', encoding='Windows-1257', newline='') as f:
+        reader = csv.reader((line.replace('\xa0', '') for line in f), delimiter=sep)
+        header = next(reader, [])
+        rows = [[parse_value(cell) for cell in row] for row in reader if row]
+    return header, rows